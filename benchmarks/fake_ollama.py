@@ -0,0 +1,89 @@
+"""Stand-in for the Ollama API used by the benchmarks.
+
+Serves /api/chat and /api/generate, streaming NDJSON tokens at a fixed rate
+after a simulated prompt evaluation delay, and reports the same timing
+fields (in nanoseconds) as the real server.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from aiohttp import web
+
+REPLIES = [
+    "Sure, here is a quick one. Why did the scarecrow win an award? Because he was outstanding in his field!",
+    "The weather looks mild today, with a light breeze in the afternoon. It might be a good day for a walk.",
+    "Okay, I'll turn on the living room light. Let me know if you want it brighter or dimmer.",
+    "A good way to relax is to take a few slow, deep breaths. Try breathing in for four seconds and out for six.",
+]
+
+class FakeOllama:
+    def __init__(self, tokens_per_s, prompt_eval_ms, cacheable):
+        self.token_delay = 1 / tokens_per_s
+        self.prompt_eval_s = prompt_eval_ms / 1000
+        self.cacheable = cacheable
+        self.counter = itertools.count(1)
+
+    def reply(self):
+        number = next(self.counter)
+        text = REPLIES[number % len(REPLIES)]
+        # A unique prefix keeps every reply out of the TTS cache, like real model output
+        return text if self.cacheable else f"Reply {number}. {text}"
+
+    def stats(self, started, eval_started, tokens):
+        finished = time.perf_counter()
+        return {
+            "total_duration": int((finished - started) * 1e9),
+            "load_duration": 0,
+            "prompt_eval_count": 64,
+            "prompt_eval_duration": int((eval_started - started) * 1e9),
+            "eval_count": tokens,
+            "eval_duration": int((finished - eval_started) * 1e9)
+        }
+
+    async def respond(self, request, chunk_for):
+        body = await request.json()
+        started = time.perf_counter()
+        await asyncio.sleep(self.prompt_eval_s)
+        eval_started = time.perf_counter()
+        words = [word + " " for word in self.reply().split(" ")]
+
+        if not body.get("stream", True):
+            await asyncio.sleep(self.token_delay * len(words))
+            return web.json_response({**chunk_for("".join(words)), "done": True,
+                                      **self.stats(started, eval_started, len(words))})
+
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        for word in words:
+            await asyncio.sleep(self.token_delay)
+            await response.write((json.dumps({**chunk_for(word), "done": False}) + "\n").encode())
+        final = {**chunk_for(""), "done": True, **self.stats(started, eval_started, len(words))}
+        await response.write((json.dumps(final) + "\n").encode())
+        await response.write_eof()
+        return response
+
+    async def chat(self, request):
+        return await self.respond(request, lambda text: {"message": {"role": "assistant", "content": text}})
+
+    async def generate(self, request):
+        return await self.respond(request, lambda text: {"response": text})
+
+def make_app(tokens_per_s=40, prompt_eval_ms=150, cacheable=False):
+    fake = FakeOllama(tokens_per_s, prompt_eval_ms, cacheable)
+    app = web.Application()
+    app.router.add_post("/api/chat", fake.chat)
+    app.router.add_post("/api/generate", fake.generate)
+    app.router.add_get("/", lambda request: web.Response(text="Ollama is running"))
+    return app
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Ollama server")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--tokens-per-s", type=float, default=40)
+    parser.add_argument("--prompt-eval-ms", type=float, default=150)
+    parser.add_argument("--cacheable", action="store_true", help="Repeat identical replies")
+    args = parser.parse_args()
+    web.run_app(make_app(args.tokens_per_s, args.prompt_eval_ms, args.cacheable),
+                host="127.0.0.1", port=args.port, print=None)
@@ -0,0 +1,500 @@
+"""End-to-end load and latency benchmark for the voice assistant services.
+
+Starts the coordinator, STT, TTS and IoT apps as local uvicorn processes
+against stand-in backends (fake_ollama.py and the edge_tts/whisper stubs in
+stubs/), drives each scenario at a fixed concurrency and reports latency
+percentiles, throughput and time to first audio.
+
+    python benchmarks/run_benchmark.py --concurrency 8 --requests 200
+    python benchmarks/run_benchmark.py --save-baseline
+    python benchmarks/run_benchmark.py --compare benchmarks/baseline.json
+
+Scenarios:
+    process_text  POST /process_text on the coordinator
+    ws            streamed turns over the coordinator /ws (time to first token and audio)
+    upload        POST /upload on the STT service with a short WAV recording
+    udp           simulated ESP32 recordings over UDP, timed from END to the final transcript
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import wave
+from contextlib import asynccontextmanager
+from pathlib import Path
+import aiohttp
+import numpy as np
+
+BENCH_DIR = Path(__file__).resolve().parent
+SERVICES_DIR = BENCH_DIR.parent / "services"
+SAMPLE_RATE = 16000
+UDP_PACKET_MS = 20  # Audio per simulated ESP32 datagram
+
+PROMPTS = [
+    "tell me a joke",
+    "what's the weather like today?",
+    "turn on the bedroom light",
+    "how can I relax after work?",
+    "turn off the living room fan",
+]
+
+def free_port(kind=socket.SOCK_STREAM):
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def elapsed_ms(started):
+    return round((time.perf_counter() - started) * 1000, 1)
+
+def make_pcm(duration_s):
+    """Speech-like test signal: two modulated tone bursts separated by a short pause"""
+    t = np.arange(int(duration_s * SAMPLE_RATE)) / SAMPLE_RATE
+    rng = np.random.default_rng(0)
+    signal = 0.3 * np.sin(2 * np.pi * 220 * t) * (0.6 + 0.4 * np.sin(2 * np.pi * 3 * t))
+    signal += 0.01 * rng.standard_normal(len(t))
+    lead, pause = 0.2, 0.3
+    burst = (duration_s - 2 * lead - pause) / 2
+    speech = ((t >= lead) & (t < lead + burst)) | ((t >= lead + burst + pause) & (t < duration_s - lead))
+    signal = np.where(speech, signal, 0.002 * rng.standard_normal(len(t)))
+    return (np.clip(signal, -1, 1) * 32767).astype(np.int16).tobytes()
+
+def make_wav(pcm):
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(SAMPLE_RATE)
+        wf.writeframes(pcm)
+    return buffer.getvalue()
+
+class Service:
+    """One service process started for the benchmark"""
+
+    def __init__(self, name, cmd, cwd, env, port, ready_path="/"):
+        self.name = name
+        self.cmd = cmd
+        self.cwd = cwd
+        self.env = env
+        self.port = port
+        self.ready_path = ready_path
+        self.process = None
+        self.log = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.port}"
+
+    def start(self, log_dir):
+        self.log_path = Path(log_dir) / f"{self.name}.log"
+        self.log = open(self.log_path, "wb")
+        self.process = subprocess.Popen(self.cmd, cwd=self.cwd, env=self.env,
+                                        stdout=self.log, stderr=subprocess.STDOUT)
+
+    async def wait_ready(self, http, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(f"{self.name} exited with code {self.process.returncode}, see {self.log_path}")
+            try:
+                async with http.get(f"{self.url}{self.ready_path}") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"{self.name} not ready after {timeout} s, see {self.log_path}")
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        if self.log:
+            self.log.close()
+
+def uvicorn_cmd(port):
+    return [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1",
+            "--port", str(port), "--log-level", "warning"]
+
+def with_pythonpath(env, path):
+    return {**env, "PYTHONPATH": os.pathsep.join(filter(None, [str(path), env.get("PYTHONPATH")]))}
+
+def build_stack(args, workdir):
+    """Create the service processes, in start order, plus the STT UDP port"""
+    env = dict(os.environ)
+    env.update(item.split("=", 1) for item in args.env)
+    audio_dir = str(Path(workdir) / "audio")
+    ports = {name: free_port() for name in ("ollama", "stt", "tts", "iot", "coordinator")}
+    udp_port = free_port(socket.SOCK_DGRAM)
+
+    ollama_cmd = [sys.executable, str(BENCH_DIR / "fake_ollama.py"), "--port", str(ports["ollama"]),
+                  "--tokens-per-s", str(args.tokens_per_s), "--prompt-eval-ms", str(args.prompt_eval_ms)]
+    if args.cacheable_replies:
+        ollama_cmd.append("--cacheable")
+
+    tts_env = with_pythonpath({**env, "AUDIO_DIR": audio_dir,
+                               "BENCH_TTS_FIRST_CHUNK_MS": str(args.tts_first_chunk_ms)},
+                              BENCH_DIR / "stubs" / "tts")
+    stt_env = {**env, "AUDIO_DIR": audio_dir, "UDP_PORT": str(udp_port),
+               "WHISPER_MODEL": args.whisper_model, "BENCH_STT_RTF": str(args.stt_rtf)}
+    if not args.real_whisper:
+        stt_env = with_pythonpath(stt_env, BENCH_DIR / "stubs" / "whisper")
+
+    coordinator_env = {**env}
+    for name in ("ollama", "stt", "tts", "iot"):
+        coordinator_env[f"{name.upper()}_HOST"] = "127.0.0.1"
+        coordinator_env[f"{name.upper()}_PORT"] = str(ports[name])
+
+    services = [
+        Service("ollama", ollama_cmd, BENCH_DIR, env, ports["ollama"]),
+        Service("iot", uvicorn_cmd(ports["iot"]), SERVICES_DIR / "iot", env, ports["iot"]),
+        Service("tts", uvicorn_cmd(ports["tts"]), SERVICES_DIR / "tts", tts_env, ports["tts"]),
+        Service("stt", uvicorn_cmd(ports["stt"]), SERVICES_DIR / "stt", stt_env, ports["stt"], "/ready"),
+        Service("coordinator", uvicorn_cmd(ports["coordinator"]), SERVICES_DIR / "coordinator",
+                coordinator_env, ports["coordinator"]),
+    ]
+    return services, udp_port
+
+class BenchContext:
+    """Shared state handed to every scenario worker"""
+
+    def __init__(self, args, http, urls, udp_port):
+        self.args = args
+        self.http = http
+        self.urls = urls
+        self.udp_port = udp_port
+        self.pcm = make_pcm(args.utterance_s)
+        self.wav = make_wav(self.pcm)
+        self.transcripts = {}  # UDP session "host:port" -> future for its final transcript
+
+    async def follow_transcripts(self):
+        """Resolve waiting UDP recordings from the STT transcript feed"""
+        async with self.http.ws_connect(f"{self.urls['stt']}/ws/transcripts") as ws:
+            async for message in ws:
+                frame = json.loads(message.data)
+                future = self.transcripts.pop(frame.get("session"), None) if frame.get("type") == "final" else None
+                if future and not future.done():
+                    future.set_result(frame)
+
+def prompt_cycle(worker_id):
+    return itertools.islice(itertools.cycle(PROMPTS), worker_id % len(PROMPTS), None)
+
+@asynccontextmanager
+async def process_text_scenario(ctx, worker_id):
+    prompts = prompt_cycle(worker_id)
+
+    async def step():
+        started = time.perf_counter()
+        async with ctx.http.post(f"{ctx.urls['coordinator']}/process_text", json={"text": next(prompts)}) as response:
+            body = await response.json()
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}: {body.get('error')}")
+        latency = elapsed_ms(started)
+        # Audio is only available once the whole response arrives
+        return {"latency_ms": latency, "ttfa_ms": latency, "fast_path": bool(body.get("fast_path"))}
+
+    yield step
+
+@asynccontextmanager
+async def ws_scenario(ctx, worker_id):
+    prompts = prompt_cycle(worker_id)
+    async with ctx.http.ws_connect(f"{ctx.urls['coordinator']}/ws") as ws:
+        async def step():
+            started = time.perf_counter()
+            await ws.send_json({"type": "text", "text": next(prompts), "stream": True})
+            sample = {}
+            while True:
+                message = await ws.receive()
+                if message.type == aiohttp.WSMsgType.BINARY:
+                    continue  # Inline audio following an audio_segment or response frame
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    raise RuntimeError("WebSocket closed")
+                frame = json.loads(message.data)
+                kind = frame.get("type")
+                if kind == "token":
+                    sample.setdefault("ttft_ms", elapsed_ms(started))
+                elif kind == "audio_segment":
+                    sample.setdefault("ttfa_ms", elapsed_ms(started))
+                elif kind == "error":
+                    raise RuntimeError(frame.get("error"))
+                elif kind == "response":
+                    sample["latency_ms"] = elapsed_ms(started)
+                    sample.setdefault("ttfa_ms", sample["latency_ms"])
+                    sample["fast_path"] = bool(frame.get("fast_path"))
+                    return sample
+
+        yield step
+
+@asynccontextmanager
+async def upload_scenario(ctx, worker_id):
+    async def step():
+        form = aiohttp.FormData()
+        form.add_field("file", ctx.wav, filename="bench.wav", content_type="audio/wav")
+        started = time.perf_counter()
+        async with ctx.http.post(f"{ctx.urls['stt']}/upload", data=form) as response:
+            body = await response.json()
+            if response.status != 200:
+                raise RuntimeError(f"HTTP {response.status}: {body.get('error')}")
+        return {"latency_ms": elapsed_ms(started)}
+
+    yield step
+
+@asynccontextmanager
+async def udp_scenario(ctx, worker_id):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(
+        asyncio.DatagramProtocol, remote_addr=("127.0.0.1", ctx.udp_port)
+    )
+    session = "{}:{}".format(*transport.get_extra_info("sockname")[:2])
+    packet_bytes = SAMPLE_RATE * UDP_PACKET_MS // 1000 * 2
+    packets = [ctx.pcm[i:i + packet_bytes] for i in range(0, len(ctx.pcm), packet_bytes)]
+    interval = UDP_PACKET_MS / 1000 * ctx.args.udp_pace
+
+    async def step():
+        future = loop.create_future()
+        ctx.transcripts[session] = future
+        started = time.perf_counter()
+        transport.sendto(b"START")
+        for seq, payload in enumerate(packets):
+            transport.sendto(b"SEQ" + struct.pack(">I", seq) + payload)
+            # Pace against the start time so sleep overshoot does not accumulate
+            delay = started + (seq + 1) * interval - time.perf_counter()
+            await asyncio.sleep(max(0, delay) if interval else 0)
+        ended = time.perf_counter()
+        transport.sendto(b"END")
+        try:
+            await asyncio.wait_for(future, ctx.args.timeout)
+        finally:
+            ctx.transcripts.pop(session, None)
+        return {"latency_ms": elapsed_ms(ended), "recording_ms": round((ended - started) * 1000, 1)}
+
+    try:
+        yield step
+    finally:
+        transport.close()
+
+SCENARIOS = {
+    "process_text": process_text_scenario,
+    "ws": ws_scenario,
+    "upload": upload_scenario,
+    "udp": udp_scenario,
+}
+
+async def run_scenario(ctx, name, concurrency, total):
+    """Run total requests of one scenario over concurrency workers and summarize them"""
+    counter = itertools.count()
+    samples, errors = [], []
+
+    async def worker(worker_id):
+        async with SCENARIOS[name](ctx, worker_id) as step:
+            while next(counter) < total:
+                try:
+                    samples.append(await asyncio.wait_for(step(), ctx.args.timeout))
+                except Exception as e:
+                    errors.append(f"{type(e).__name__}: {e}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(worker_id) for worker_id in range(min(concurrency, total))))
+    return summarize(samples, errors, time.perf_counter() - started)
+
+def percentiles(values):
+    values = np.asarray(values, dtype=float)
+    return {
+        "p50": round(float(np.percentile(values, 50)), 1),
+        "p95": round(float(np.percentile(values, 95)), 1),
+        "p99": round(float(np.percentile(values, 99)), 1),
+        "mean": round(float(values.mean()), 1),
+        "max": round(float(values.max()), 1)
+    }
+
+def summarize(samples, errors, wall_s):
+    result = {
+        "requests": len(samples) + len(errors),
+        "ok": len(samples),
+        "errors": len(errors),
+        "wall_s": round(wall_s, 2),
+        "throughput_rps": round(len(samples) / wall_s, 2) if wall_s else 0.0
+    }
+    for metric in ("latency_ms", "ttft_ms", "ttfa_ms", "recording_ms"):
+        values = [sample[metric] for sample in samples if metric in sample]
+        if values:
+            result[metric] = percentiles(values)
+    flagged = [sample["fast_path"] for sample in samples if "fast_path" in sample]
+    if flagged:
+        result["fast_path_share"] = round(sum(flagged) / len(flagged), 2)
+    if errors:
+        result["error_examples"] = sorted(set(errors))[:5]
+    return result
+
+STAGE_LINE = re.compile(r'^voice_stage_duration_seconds_(sum|count)\{stage="([^"]+)"\} (\S+)$')
+
+async def collect_stage_metrics(http, services):
+    """Mean time per stage over the whole run, from each service's /metrics"""
+    stages = {}
+    for service in services:
+        if service.name == "ollama":
+            continue
+        totals = {}
+        async with http.get(f"{service.url}/metrics") as response:
+            for line in (await response.text()).splitlines():
+                match = STAGE_LINE.match(line)
+                if match:
+                    totals.setdefault(match.group(2), {})[match.group(1)] = float(match.group(3))
+        stages[service.name] = {
+            stage: {"count": int(value["count"]), "mean_ms": round(value["sum"] / value["count"] * 1000, 1)}
+            for stage, value in sorted(totals.items()) if value.get("count")
+        }
+    return stages
+
+def print_report(results):
+    header = f"{'scenario':<14}{'ok':>6}{'err':>5}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'ttfa p50':>10}{'ttfa p95':>10}"
+    print(header)
+    print("-" * len(header))
+    for name, result in results.items():
+        latency = result.get("latency_ms", {})
+        ttfa = result.get("ttfa_ms", {})
+        print(f"{name:<14}{result['ok']:>6}{result['errors']:>5}{result['throughput_rps']:>8}"
+              f"{latency.get('p50', '-'):>9}{latency.get('p95', '-'):>9}{latency.get('p99', '-'):>9}"
+              f"{ttfa.get('p50', '-'):>10}{ttfa.get('p95', '-'):>10}")
+        for example in result.get("error_examples", []):
+            print(f"    error: {example}")
+
+def compare(current, baseline, tolerance, min_delta_ms):
+    """List metrics that got worse than the baseline by more than the tolerance"""
+    regressions = []
+    for name, result in current["scenarios"].items():
+        base = baseline.get("scenarios", {}).get(name)
+        if not base:
+            continue
+        for metric in ("latency_ms", "ttft_ms", "ttfa_ms"):
+            for quantile in ("p50", "p95", "p99"):
+                if metric not in result or metric not in base:
+                    continue
+                old, new = base[metric][quantile], result[metric][quantile]
+                if new > old * (1 + tolerance) and new - old > min_delta_ms:
+                    regressions.append(f"{name} {metric} {quantile}: {old} -> {new} ms")
+        if result["throughput_rps"] < base["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name} throughput: {base['throughput_rps']} -> {result['throughput_rps']} rps")
+        old_errors = base["errors"] / max(base["requests"], 1)
+        new_errors = result["errors"] / max(result["requests"], 1)
+        if new_errors > old_errors + 0.01:
+            regressions.append(f"{name} error rate: {old_errors:.1%} -> {new_errors:.1%}")
+    return regressions
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def run(args):
+    workdir = tempfile.mkdtemp(prefix="voice-bench-")
+    services, udp_port = build_stack(args, workdir)
+    timeout = aiohttp.ClientTimeout(total=args.timeout)
+    connector = aiohttp.TCPConnector(limit=0)
+    ok = False
+    try:
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as http:
+            for service in services:
+                service.start(workdir)
+                await service.wait_ready(http)
+            print(f"Services ready (logs in {workdir})")
+
+            ctx = BenchContext(args, http, {service.name: service.url for service in services}, udp_port)
+            feed = asyncio.create_task(ctx.follow_transcripts())
+            results = {}
+            try:
+                for name in args.scenarios:
+                    if args.warmup:
+                        await run_scenario(ctx, name, 1, args.warmup)
+                    print(f"Running {name}: {args.requests} requests, concurrency {args.concurrency}")
+                    results[name] = await run_scenario(ctx, name, args.concurrency, args.requests)
+            finally:
+                feed.cancel()
+            stages = await collect_stage_metrics(http, services)
+        ok = True
+    finally:
+        for service in reversed(services):
+            service.stop()
+        if ok and not args.keep_workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "revision": git_revision(),
+        "host": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": {key: value for key, value in vars(args).items()
+                   if key not in ("output", "save_baseline", "compare", "keep_workdir")},
+        "scenarios": results,
+        "stages": stages
+    }
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Voice assistant load and latency benchmark")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        type=lambda value: [name for name in value.split(",") if name],
+                        help=f"Comma-separated scenarios ({', '.join(SCENARIOS)})")
+    parser.add_argument("--concurrency", type=int, default=4, help="Concurrent clients per scenario")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per scenario")
+    parser.add_argument("--warmup", type=int, default=3, help="Unmeasured requests before each scenario")
+    parser.add_argument("--timeout", type=float, default=60, help="Per-request timeout in seconds")
+    parser.add_argument("--tokens-per-s", type=float, default=40, help="Fake Ollama generation speed")
+    parser.add_argument("--prompt-eval-ms", type=float, default=150, help="Fake Ollama prompt evaluation time")
+    parser.add_argument("--cacheable-replies", action="store_true", help="Let the TTS cache serve repeated replies")
+    parser.add_argument("--tts-first-chunk-ms", type=float, default=120, help="Fake TTS latency to first audio")
+    parser.add_argument("--stt-rtf", type=float, default=0.05, help="Stub Whisper seconds of compute per audio second")
+    parser.add_argument("--real-whisper", action="store_true", help="Use the installed Whisper instead of the stub")
+    parser.add_argument("--whisper-model", default="tiny", help="Whisper model for --real-whisper")
+    parser.add_argument("--utterance-s", type=float, default=2.0, help="Length of the test recording")
+    parser.add_argument("--udp-pace", type=float, default=1.0,
+                        help="UDP send speed as a fraction of real time (1 = real time, 0 = as fast as possible)")
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra environment variable for all services (repeatable)")
+    parser.add_argument("--output", default=str(BENCH_DIR / "results" / "latest.json"), help="Where to write results")
+    parser.add_argument("--save-baseline", nargs="?", const=str(BENCH_DIR / "baseline.json"),
+                        help="Also write the results as the baseline")
+    parser.add_argument("--compare", help="Baseline to compare against; exits 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slowdown before flagging")
+    parser.add_argument("--min-delta-ms", type=float, default=5, help="Ignore slowdowns smaller than this")
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep service logs and audio after the run")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+def main():
+    args = parse_args()
+    report = asyncio.run(run(args))
+    print_report(report["scenarios"])
+
+    for path in filter(None, [args.output, args.save_baseline]):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        Path(path).write_text(json.dumps(report, indent=2))
+        print(f"Results written to {path}")
+
+    if args.compare:
+        regressions = compare(report, json.loads(Path(args.compare).read_text()), args.tolerance, args.min_delta_ms)
+        if regressions:
+            print(f"Regressions against {args.compare}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions against {args.compare}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""Benchmark stand-in for edge_tts: returns silent MP3 frames after a simulated delay.
+
+BENCH_TTS_FIRST_CHUNK_MS sets the latency before the first audio chunk and
+BENCH_TTS_CHARS_PER_S how quickly the rest of the text is synthesized.
+"""
+import asyncio
+import os
+
+FIRST_CHUNK_S = float(os.getenv("BENCH_TTS_FIRST_CHUNK_MS", 120)) / 1000
+CHARS_PER_S = float(os.getenv("BENCH_TTS_CHARS_PER_S", 400))
+
+# One silent 48 kbps MPEG-1 Layer III frame (24 ms of audio at 24 kHz)
+SILENT_FRAME = b"\xff\xf3\x64\xc4" + bytes(140)
+FRAMES_PER_CHAR = 3
+CHARS_PER_CHUNK = 20
+
+class Communicate:
+    def __init__(self, text, voice=None, **kwargs):
+        self.text = text
+        self.voice = voice
+
+    async def stream(self):
+        await asyncio.sleep(FIRST_CHUNK_S)
+        for start in range(0, max(len(self.text), 1), CHARS_PER_CHUNK):
+            part = self.text[start:start + CHARS_PER_CHUNK]
+            if start:
+                await asyncio.sleep(len(part) / CHARS_PER_S)
+            yield {"type": "audio", "data": SILENT_FRAME * (FRAMES_PER_CHAR * max(len(part), 1))}
+        yield {"type": "WordBoundary", "offset": 0, "duration": 0, "text": self.text}
+
+    async def save(self, audio_fname):
+        with open(audio_fname, "wb") as f:
+            async for chunk in self.stream():
+                if chunk["type"] == "audio":
+                    f.write(chunk["data"])
+
+async def list_voices():
+    return [{"Name": "Benchmark Voice", "ShortName": "en-US-AriaNeural", "Gender": "Female", "Locale": "en-US"}]
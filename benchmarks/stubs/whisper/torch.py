@@ -0,0 +1,12 @@
+"""Benchmark stand-in for the few torch calls the STT service makes."""
+import numpy as np
+
+class Tensor(np.ndarray):
+    def to(self, device):
+        return self
+
+def set_num_threads(count):
+    pass
+
+def stack(arrays):
+    return np.stack(arrays).view(Tensor)
@@ -0,0 +1,55 @@
+"""Benchmark stand-in for openai-whisper.
+
+Inference blocks the calling worker thread for BENCH_STT_MIN_MS plus
+BENCH_STT_RTF seconds per second of audio, roughly like a small model on CPU,
+and returns a fixed device command as the transcript. Batched decodes cost
+one call's overhead plus per-utterance time.
+"""
+import os
+import time
+import types
+import numpy as np
+
+SAMPLE_RATE = 16000
+MIN_S = float(os.getenv("BENCH_STT_MIN_MS", 40)) / 1000
+RTF = float(os.getenv("BENCH_STT_RTF", 0.05))
+TEXT = os.getenv("BENCH_STT_TEXT", "turn on the kitchen light")
+
+audio = types.SimpleNamespace(N_SAMPLES=30 * SAMPLE_RATE)
+
+def available_models():
+    return ["tiny.en", "tiny", "base.en", "base", "small.en", "small", "medium.en", "medium", "large"]
+
+class Model:
+    def __init__(self, name):
+        self.name = name
+        self.dims = types.SimpleNamespace(n_mels=80)
+        self.device = "cpu"
+
+    def transcribe(self, audio_input, **kwargs):
+        samples = 0 if isinstance(audio_input, str) else len(audio_input)
+        time.sleep(MIN_S + RTF * samples / SAMPLE_RATE)
+        return {"text": f" {TEXT}", "language": "en", "segments": []}
+
+def load_model(name, **kwargs):
+    return Model(name)
+
+def pad_or_trim(array, length=30 * SAMPLE_RATE):
+    return array
+
+def log_mel_spectrogram(array, n_mels=80):
+    # Only the length matters to decode() below
+    return np.asarray([len(array)], dtype=np.float32)
+
+class DecodingOptions:
+    def __init__(self, **kwargs):
+        self.options = kwargs
+
+class DecodingResult:
+    def __init__(self, text):
+        self.text = text
+        self.language = "en"
+
+def decode(model, mel, options=None):
+    time.sleep(MIN_S + RTF * sum(float(m[0]) for m in mel) / SAMPLE_RATE)
+    return [DecodingResult(f" {TEXT}") for _ in mel]
@@ -1,23 +1,80 @@
 import os
+import re
 import json
+import base64
 import logging
 import asyncio
+import time
+import uuid
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
 import aiohttp
 import websockets
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException, Request
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
-import requests
 from pydantic import BaseModel
+from typing import Optional
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+# Correlation ID of the turn being handled; sent downstream as X-Request-ID and added to log lines
+request_id_var = contextvars.ContextVar("request_id", default="-")
+_record_factory = logging.getLogRecordFactory()
+
+def record_with_request_id(*args, **kwargs):
+    record = _record_factory(*args, **kwargs)
+    record.request_id = request_id_var.get()
+    return record
+
+logging.setLogRecordFactory(record_with_request_id)
 
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+# Prometheus metrics, served at /metrics
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGE_SECONDS = Histogram("voice_stage_duration_seconds", "Time spent in each stage of a voice turn",
+                          ["stage"], buckets=STAGE_BUCKETS)
+UPSTREAM_SECONDS = Histogram("voice_upstream_request_duration_seconds", "Downstream HTTP request latency",
+                             ["service"], buckets=STAGE_BUCKETS)
+UPSTREAM_IN_FLIGHT = Gauge("voice_upstream_requests_in_flight", "Downstream HTTP requests in flight", ["service"])
+TURNS = Counter("voice_turns_total", "Turns answered, by path", ["path"])
+LLM_REJECTED = Counter("voice_llm_rejected_total", "LLM requests turned away by the scheduler", ["reason"])
+WS_CLIENTS = Gauge("voice_websocket_clients", "Connected WebSocket clients")
+
+@contextmanager
+def timed(stage):
+    """Record how long the block takes under the given stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+# Fire-and-forget tasks; the event loop only keeps weak references to tasks,
+# so they are held here until they finish
+background_tasks = set()
+
+def start_background_task(coro):
+    """Run a coroutine as a task that nobody awaits, keeping it referenced until done"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+def observe_ollama_stats(result):
+    """Record Ollama's own load, prompt evaluation and generation timings (reported in ns)"""
+    for key, stage in (("load_duration", "llm_load"), ("prompt_eval_duration", "llm_prompt_eval"),
+                       ("eval_duration", "llm_generation")):
+        if result.get(key):
+            STAGE_SECONDS.labels(stage).observe(result[key] / 1e9)
+
 # Environment variable configuration
 OLLAMA_HOST = os.getenv("OLLAMA_HOST", "ollama")
 OLLAMA_PORT = os.getenv("OLLAMA_PORT", "11434")
@@ -29,6 +86,45 @@ TTS_PORT = os.getenv("TTS_PORT", "8001")
 IOT_HOST = os.getenv("IOT_HOST", "iot-control")
 IOT_PORT = os.getenv("IOT_PORT", "8002")
 
+# Downstream HTTP client limits (max concurrent requests, total timeout in seconds)
+OLLAMA_MAX_CONCURRENCY = int(os.getenv("OLLAMA_MAX_CONCURRENCY", 4))
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", 120))
+STT_MAX_CONCURRENCY = int(os.getenv("STT_MAX_CONCURRENCY", 8))
+STT_TIMEOUT = float(os.getenv("STT_TIMEOUT", 60))
+TTS_MAX_CONCURRENCY = int(os.getenv("TTS_MAX_CONCURRENCY", 8))
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", 30))
+IOT_MAX_CONCURRENCY = int(os.getenv("IOT_MAX_CONCURRENCY", 16))
+IOT_TIMEOUT = float(os.getenv("IOT_TIMEOUT", 5))
+
+# Sentence-pipelined TTS for streamed replies
+TTS_PIPELINE = os.getenv("TTS_PIPELINE", "true").lower() == "true"
+SENTENCE_MIN_CHARS = int(os.getenv("SENTENCE_MIN_CHARS", 20))
+
+# Ollama chat sessions: how long the model stays loaded and how much history each client keeps
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_HISTORY_TOKENS = int(os.getenv("OLLAMA_HISTORY_TOKENS", 2048))
+
+# Deterministic handling of simple device commands without calling the LLM
+FAST_PATH_ENABLED = os.getenv("FAST_PATH_ENABLED", "true").lower() == "true"
+FAST_PATH_MAX_WORDS = int(os.getenv("FAST_PATH_MAX_WORDS", 12))
+
+# Timeouts for the post-LLM stages, which run concurrently
+IOT_STAGE_TIMEOUT = float(os.getenv("IOT_STAGE_TIMEOUT", 5))
+TTS_STAGE_TIMEOUT = float(os.getenv("TTS_STAGE_TIMEOUT", 30))
+
+# LLM scheduler: concurrent generations, queue size and how long a request may wait (seconds)
+LLM_MAX_INFLIGHT = int(os.getenv("LLM_MAX_INFLIGHT", 2))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", 64))
+LLM_QUEUE_DEADLINE = float(os.getenv("LLM_QUEUE_DEADLINE", 20))
+
+# How audio travels between services and to clients: "bytes" relays it inline,
+# "path" exchanges file paths on the shared AUDIO_DIR volume (clients may override per request)
+AUDIO_TRANSPORT = os.getenv("AUDIO_TRANSPORT", "bytes")
+AUDIO_TRANSPORTS = ("bytes", "path")
+
+# Seconds to wait before reconnecting to the IoT service's device update feed
+IOT_RECONNECT_DELAY = float(os.getenv("IOT_RECONNECT_DELAY", 5))
+
 # Create FastAPI application
 app = FastAPI(title="AI Voice Assistant Coordinator Service")
 
@@ -39,42 +135,388 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
+@app.middleware("http")
+async def correlation_id_middleware(request: Request, call_next):
+    """Tag the request with the caller's X-Request-ID, or a new one, and echo it back"""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
 # Connected clients
 connected_clients = {}
 
+class ServiceClient:
+    """Long-lived HTTP client for one downstream service.
+
+    Keeps a keep-alive connection pool open for the lifetime of the app and
+    caps the number of in-flight requests, so concurrent conversations share
+    connections instead of opening a new one per call.
+    """
+
+    def __init__(self, name, host, port, max_concurrency, timeout):
+        self.name = name
+        self.base_url = f"http://{host}:{port}"
+        self.max_concurrency = max_concurrency
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.session = None
+
+    async def start(self):
+        connector = aiohttp.TCPConnector(
+            limit=self.max_concurrency,
+            keepalive_timeout=60
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        logger.info(f"HTTP client for {self.name} ready: {self.base_url} (max {self.max_concurrency} concurrent)")
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    @asynccontextmanager
+    async def request(self, method, path, **kwargs):
+        """Open a request and yield the response without reading the body"""
+        request_id = request_id_var.get()
+        if request_id != "-":
+            kwargs["headers"] = {**kwargs.get("headers", {}), "X-Request-ID": request_id}
+        async with self.semaphore:
+            UPSTREAM_IN_FLIGHT.labels(self.name).inc()
+            started = time.perf_counter()
+            try:
+                async with self.session.request(method, f"{self.base_url}{path}", **kwargs) as response:
+                    yield response
+            finally:
+                UPSTREAM_IN_FLIGHT.labels(self.name).dec()
+                UPSTREAM_SECONDS.labels(self.name).observe(time.perf_counter() - started)
+
+    async def get_json(self, path, **kwargs):
+        """GET a path and return the decoded JSON body, raising on HTTP errors"""
+        async with self.request("GET", path, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json()
+
+    async def post_json(self, path, payload, **kwargs):
+        """POST a JSON payload and return the decoded JSON body, raising on HTTP errors"""
+        async with self.request("POST", path, json=payload, **kwargs) as response:
+            response.raise_for_status()
+            return await response.json()
+
+# Shared clients for downstream services
+ollama_client = ServiceClient("ollama", OLLAMA_HOST, OLLAMA_PORT, OLLAMA_MAX_CONCURRENCY, OLLAMA_TIMEOUT)
+stt_client = ServiceClient("stt", STT_HOST, STT_PORT, STT_MAX_CONCURRENCY, STT_TIMEOUT)
+tts_client = ServiceClient("tts", TTS_HOST, TTS_PORT, TTS_MAX_CONCURRENCY, TTS_TIMEOUT)
+iot_client = ServiceClient("iot", IOT_HOST, IOT_PORT, IOT_MAX_CONCURRENCY, IOT_TIMEOUT)
+service_clients = [ollama_client, stt_client, tts_client, iot_client]
+
+def catalog_of(devices):
+    """Device types and locations, ignoring their states"""
+    return {device: sorted(locations) for device, locations in devices.items()}
+
+# Client the current request belongs to, used for fair scheduling
+current_client = contextvars.ContextVar("current_client", default="anonymous")
+
+# Audio transport for the current turn
+audio_transport_var = contextvars.ContextVar("audio_transport", default=AUDIO_TRANSPORT)
+
+def select_audio_transport(requested):
+    """Use the transport a client asked for, or the configured default"""
+    audio_transport_var.set(requested if requested in AUDIO_TRANSPORTS else AUDIO_TRANSPORT)
+
+class SchedulerRejectedError(Exception):
+    """Raised when the LLM scheduler cannot admit a request within its deadline"""
+
+class LLMScheduler:
+    """Admission control and fair queuing in front of Ollama.
+
+    At most max_inflight generations run at once. Waiting requests are kept
+    in one FIFO per client and slots are handed out round-robin across
+    clients, so a chatty client cannot starve the others; device-control
+    turns form a priority tier that is served first. A request whose
+    expected wait already exceeds its deadline is rejected up front, and one
+    still waiting when its deadline passes is dropped.
+    """
+
+    def __init__(self, max_inflight, max_queue, deadline):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.inflight = 0
+        self.tiers = (OrderedDict(), OrderedDict())  # (priority, normal): client -> deque of futures
+        self.waiting = 0
+        self.avg_service_s = 2.0  # Moving average of generation time, used to estimate waits
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.total_wait_s = 0.0
+
+    @asynccontextmanager
+    async def slot(self, priority=False):
+        """Hold one LLM slot for the duration of the block; yields the queue wait in ms"""
+        waited = await self.acquire(current_client.get(), priority)
+        STAGE_SECONDS.labels("llm_queue").observe(waited)
+        started = time.monotonic()
+        try:
+            yield round(waited * 1000, 1)
+        finally:
+            self.avg_service_s = 0.8 * self.avg_service_s + 0.2 * (time.monotonic() - started)
+            self.inflight -= 1
+            self._dispatch()
+
+    async def acquire(self, client_id, priority=False):
+        if self.inflight < self.max_inflight and self.waiting == 0:
+            self.inflight += 1
+            self.admitted += 1
+            return 0.0
+        
+        expected_wait = (self.waiting + 1) / self.max_inflight * self.avg_service_s
+        if self.waiting >= self.max_queue or expected_wait > self.deadline:
+            self.rejected += 1
+            LLM_REJECTED.labels("busy").inc()
+            raise SchedulerRejectedError(
+                f"LLM busy: {self.waiting} requests queued, expected wait {expected_wait:.1f} s"
+            )
+        
+        future = asyncio.get_running_loop().create_future()
+        tier = self.tiers[0 if priority else 1]
+        tier.setdefault(client_id, deque()).append(future)
+        self.waiting += 1
+        enqueued = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.deadline)
+        except asyncio.TimeoutError:
+            self._remove(tier, client_id, future)
+            self.expired += 1
+            LLM_REJECTED.labels("deadline").inc()
+            raise SchedulerRejectedError(f"LLM queue deadline of {self.deadline} s exceeded")
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Slot was granted just as the caller went away; pass it on
+                self.inflight -= 1
+                self._dispatch()
+            else:
+                self._remove(tier, client_id, future)
+            raise
+        
+        waited = time.monotonic() - enqueued
+        self.admitted += 1
+        self.total_wait_s += waited
+        return waited
+
+    def _remove(self, tier, client_id, future):
+        queue = tier.get(client_id)
+        if queue and future in queue:
+            queue.remove(future)
+            self.waiting -= 1
+            if not queue:
+                del tier[client_id]
+
+    def _dispatch(self):
+        """Hand free slots to waiting requests, round-robin across clients"""
+        while self.inflight < self.max_inflight and self.waiting:
+            tier = self.tiers[0] if self.tiers[0] else self.tiers[1]
+            client_id, queue = tier.popitem(last=False)
+            future = queue.popleft()
+            self.waiting -= 1
+            if queue:
+                tier[client_id] = queue  # Back of the line for this client's next request
+            if not future.done():
+                self.inflight += 1
+                future.set_result(None)
+
+    def stats(self):
+        return {
+            "max_inflight": self.max_inflight,
+            "inflight": self.inflight,
+            "queue_depth": self.waiting,
+            "queued_by_client": {
+                str(client_id): len(queue)
+                for tier in self.tiers for client_id, queue in tier.items()
+            },
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "avg_wait_ms": round(self.total_wait_s / self.admitted * 1000, 1) if self.admitted else 0.0,
+            "avg_service_ms": round(self.avg_service_s * 1000, 1)
+        }
+
+llm_scheduler = LLMScheduler(LLM_MAX_INFLIGHT, LLM_MAX_QUEUE, LLM_QUEUE_DEADLINE)
+Gauge("voice_llm_in_flight", "LLM generations running").set_function(lambda: llm_scheduler.inflight)
+Gauge("voice_llm_queue_depth", "LLM requests waiting for a slot").set_function(lambda: llm_scheduler.waiting)
+
+class DeviceStateMirror:
+    """Local copy of IoT device states, kept in sync over the IoT service's /ws.
+
+    The rendered status text is cached and only rebuilt when a device state
+    actually changes. While the feed is disconnected, callers fall back to a
+    GET of /devices.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.devices = {}
+        self.synced = False
+        self.status_text = None
+        self.updates = 0
+        self.renders = 0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def _run(self):
+        ws_url = f"{self.client.base_url.replace('http://', 'ws://', 1)}/ws"
+        while True:
+            try:
+                async with self.client.session.ws_connect(ws_url, heartbeat=30) as ws:
+                    logger.info(f"Subscribed to device updates: {ws_url}")
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            self.handle_message(json.loads(msg.data))
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Device update feed error: {str(e)}")
+            
+            self.synced = False
+            await asyncio.sleep(IOT_RECONNECT_DELAY)
+
+    def handle_message(self, message):
+        message_type = message.get("type")
+        if message_type == "init":
+            self.replace(message.get("devices", {}))
+            self.synced = True
+        elif message_type == "device_update":
+            self.update(message.get("device"), message.get("location"), message.get("state"))
+
+    def replace(self, devices):
+        if devices != self.devices:
+            if catalog_of(devices) != catalog_of(self.devices):
+                rebuild_intent_matcher(devices)
+            self.devices = devices
+            self.status_text = None
+
+    def update(self, device, location, state):
+        locations = self.devices.setdefault(device, {})
+        if locations.get(location) != state:
+            locations[location] = state
+            self.status_text = None
+            self.updates += 1
+
+    async def get_status_text(self):
+        """Return the human readable device status, re-rendering only after changes"""
+        if not self.synced:
+            async with self.client.request("GET", "/devices") as iot_response:
+                if iot_response.status != 200:
+                    return "Unable to retrieve current device status."
+                self.replace((await iot_response.json()).get("devices", {}))
+        
+        if self.status_text is None:
+            self.status_text = format_device_states(self.devices)
+            self.renders += 1
+        return self.status_text
+
+device_mirror = DeviceStateMirror(iot_client)
+
 class AudioRequest(BaseModel):
     audio_path: str
 
 class TextRequest(BaseModel):
     text: str
 
+@app.on_event("startup")
+async def startup_event():
+    """Event handler for application startup"""
+    for client in service_clients:
+        await client.start()
+    device_mirror.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Event handler for application shutdown"""
+    await device_mirror.stop()
+    for client in service_clients:
+        await client.close()
+
 @app.get("/")
 async def root():
     return {"message": "AI Voice Assistant Coordinator Service is running"}
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/scheduler/stats")
+async def scheduler_stats():
+    """Get LLM queue depth, wait times and admission counters"""
+    return llm_scheduler.stats()
+
+def scheduler_rejected_response(error):
+    """503 response for requests the LLM scheduler could not admit"""
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(error)},
+        headers={"Retry-After": str(max(1, int(llm_scheduler.avg_service_s)))}
+    )
+
 @app.post("/process_audio")
-async def process_audio(request: AudioRequest):
-    """Process audio and return AI response"""
-    try:
-        # 1. Send audio to STT service
-        audio_path = request.audio_path
-        stt_url = f"http://{STT_HOST}:{STT_PORT}/transcribe"
-        stt_response = requests.post(stt_url, json={"audio_path": audio_path})
-        stt_response.raise_for_status()
-        transcription = stt_response.json().get("text", "")
-        
-        if not transcription:
+async def process_audio(http_request: Request, audio_transport: Optional[str] = None):
+    """Process audio and return AI response.
+
+    The body is either JSON naming an audio_path on the shared volume, or the
+    recording itself (a WAV/MP3/... file, or raw PCM as audio/pcm;rate=16000),
+    which is relayed to the STT service as is.
+    """
+    current_client.set(http_request.client.host if http_request.client else "anonymous")
+    select_audio_transport(audio_transport)
+    content_type = http_request.headers.get("content-type", "")
+    request = None
+    if content_type.startswith("application/json"):
+        try:
+            request = AudioRequest(**await http_request.json())
+        except ValueError as e:
             return JSONResponse(
                 status_code=400,
-                content={"error": "Unable to recognize audio content"}
+                content={"error": f"Invalid request: {str(e)}"}
             )
+    
+    try:
+        with timed("turn"):
+            # 1. Send audio to STT service
+            if request:
+                transcription = await transcribe_audio(request.audio_path)
+            else:
+                transcription = await transcribe_audio_bytes(await http_request.body(), content_type)
+            
+            if not transcription:
+                return JSONResponse(
+                    status_code=400,
+                    content={"error": "Unable to recognize audio content"}
+                )
+            
+            # 2. Send text to Ollama for processing
+            response = await process_text_with_llm(transcription)
         
-        # 2. Send text to Ollama for processing
-        response = await process_text_with_llm(transcription)
-        
-        return response
+        return encode_inline_audio(response)
+    
+    except SchedulerRejectedError as e:
+        return scheduler_rejected_response(e)
     
     except Exception as e:
         logger.error(f"Error processing audio: {str(e)}")
@@ -83,12 +525,49 @@ async def process_audio(request: AudioRequest):
             content={"error": f"Error processing request: {str(e)}"}
         )
 
+async def transcribe_audio(audio_path):
+    """Send an audio file path to the STT service and return the transcription"""
+    with timed("stt"):
+        stt_result = await stt_client.post_json("/transcribe", {"audio_path": audio_path})
+    return stt_result.get("text", "")
+
+async def transcribe_audio_bytes(audio, content_type):
+    """Relay recorded audio to the STT service in the request body and return the transcription"""
+    with timed("stt"):
+        async with stt_client.request("POST", "/transcribe", data=audio,
+                                      headers={"Content-Type": content_type or "application/octet-stream"}) as stt_response:
+            stt_response.raise_for_status()
+            stt_result = await stt_response.json()
+    return stt_result.get("text", "")
+
+def encode_inline_audio(response):
+    """Put inline audio into a JSON response as base64"""
+    audio = response.pop("audio", None)
+    if audio is not None:
+        response["audio_base64"] = base64.b64encode(audio).decode("ascii")
+    return response
+
+async def send_with_audio(websocket, frame):
+    """Send a JSON frame; inline audio follows as one binary frame, announced by audio_bytes"""
+    audio = frame.pop("audio", None)
+    if audio is not None:
+        frame["audio_bytes"] = len(audio)
+    await websocket.send_json(frame)
+    if audio is not None:
+        await websocket.send_bytes(audio)
+
 @app.post("/process_text")
-async def process_text(request: TextRequest):
+async def process_text(request: TextRequest, http_request: Request, audio_transport: Optional[str] = None):
     """Process text input and return AI response"""
+    current_client.set(http_request.client.host if http_request.client else "anonymous")
+    select_audio_transport(audio_transport)
     try:
-        response = await process_text_with_llm(request.text)
-        return response
+        with timed("turn"):
+            response = await process_text_with_llm(request.text)
+        return encode_inline_audio(response)
+    
+    except SchedulerRejectedError as e:
+        return scheduler_rejected_response(e)
     
     except Exception as e:
         logger.error(f"Error processing text: {str(e)}")
@@ -97,82 +576,449 @@ async def process_text(request: TextRequest):
             content={"error": f"Error processing request: {str(e)}"}
         )
 
-async def process_text_with_llm(text_input):
+async def process_text_with_llm(text_input, session=None, websocket=None):
     """Send text to LLM and process response"""
+    # Simple device commands are answered without the LLM
+    response = await try_fast_path(text_input, session)
+    if response:
+        return response
+    
     # 1. Send text to Ollama
-    ollama_url = f"http://{OLLAMA_HOST}:{OLLAMA_PORT}/api/generate"
     ollama_payload = {
         "model": OLLAMA_MODEL,
-        "prompt": add_system_instructions(text_input),
-        "stream": False
+        "messages": await build_chat_messages(text_input, session),
+        "stream": False,
+        "keep_alive": OLLAMA_KEEP_ALIVE
     }
     
-    ollama_response = requests.post(ollama_url, json=ollama_payload)
-    ollama_response.raise_for_status()
+    async with llm_scheduler.slot(priority=is_device_turn(text_input)) as queue_wait_ms:
+        with timed("llm"):
+            ollama_result = await ollama_client.post_json("/api/chat", ollama_payload)
+    observe_ollama_stats(ollama_result)
+    TURNS.labels("llm").inc()
+    ai_text_response = ollama_result.get("message", {}).get("content", "")
+    if session:
+        session.add_turn(text_input, ai_text_response)
     
-    ai_text_response = ollama_response.json().get("response", "")
+    response = await complete_turn(text_input, ai_text_response, websocket=websocket)
+    response["queue_wait_ms"] = queue_wait_ms
+    return response
+
+def is_device_turn(text_input):
+    """Device-control turns get priority in the LLM queue"""
+    return command_intent(text_input) is not None
+
+async def stream_llm_chunks(text_input, session=None):
+    """Send text to LLM in streaming mode and yield NDJSON chunks as they arrive"""
+    ollama_payload = {
+        "model": OLLAMA_MODEL,
+        "messages": await build_chat_messages(text_input, session),
+        "stream": True,
+        "keep_alive": OLLAMA_KEEP_ALIVE
+    }
     
-    # 2. Check if IoT control is needed
-    iot_commands = extract_iot_commands(text_input, ai_text_response)
+    async with llm_scheduler.slot(priority=is_device_turn(text_input)) as queue_wait_ms:
+        async with ollama_client.request("POST", "/api/chat", json=ollama_payload) as ollama_response:
+            ollama_response.raise_for_status()
+            async for line in ollama_response.content:
+                line = line.strip()
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if "error" in chunk:
+                    raise RuntimeError(f"Ollama error: {chunk['error']}")
+                if chunk.get("done"):
+                    chunk["queue_wait_ms"] = queue_wait_ms
+                    observe_ollama_stats(chunk)
+                yield chunk
+
+class SentenceSplitter:
+    """Accumulate streamed tokens and cut them into complete sentences.
+
+    A sentence ends at terminal punctuation followed by whitespace (so "3.5"
+    is not split) or at a newline. Fragments shorter than min_chars are held
+    back and merged with the next sentence to avoid tiny TTS requests.
+    """
+
+    BOUNDARY = re.compile(r'[.!?。！？]+["\')\]]*\s+|\n+')
+
+    def __init__(self, min_chars=SENTENCE_MIN_CHARS):
+        self.min_chars = min_chars
+        self.buffer = ""
+
+    def feed(self, token):
+        """Add a token and return the sentences it completed"""
+        self.buffer += token
+        sentences = []
+        start = 0
+        for match in self.BOUNDARY.finditer(self.buffer):
+            if len(self.buffer[start:match.end()].strip()) >= self.min_chars:
+                sentences.append(self.buffer[start:match.end()].strip())
+                start = match.end()
+        self.buffer = self.buffer[start:]
+        return sentences
+
+    def flush(self):
+        """Return whatever text is left once the stream has ended"""
+        rest = self.buffer.strip()
+        self.buffer = ""
+        return [rest] if rest else []
+
+async def synthesize_audio(text):
+    """Synthesize text with the TTS service.
+
+    Returns the audio fields for a response: the audio_path in path mode, or
+    the audio bytes and their format in bytes mode.
+    """
+    if audio_transport_var.get() == "path":
+        tts_result = await tts_client.post_json("/synthesize", {"text": text})
+        return {"audio_path": tts_result.get("audio_path", "")}
     
-    if iot_commands:
-        # Send to IoT control service
-        iot_url = f"http://{IOT_HOST}:{IOT_PORT}/control"
-        iot_response = requests.post(iot_url, json={"commands": iot_commands})
-        iot_result = iot_response.json() if iot_response.status_code == 200 else {"status": "error"}
+    async with tts_client.request("POST", "/synthesize", json={"text": text, "inline": True}) as tts_response:
+        tts_response.raise_for_status()
+        return {
+            "audio_path": "",
+            "audio": await tts_response.read(),
+            "audio_format": tts_response.headers.get("X-Audio-Format", "mp3")
+        }
+
+async def synthesize_segment(text):
+    """Synthesize one sentence and return its audio fields"""
+    with timed("tts_segment"):
+        return await synthesize_audio(text)
+
+async def deliver_audio_segments(websocket, segments):
+    """Send synthesized sentences to the client in order as each one is ready"""
+    delivered = []
+    while True:
+        item = await segments.get()
+        if item is None:
+            return delivered
+        index, text, task = item
+        frame = {"type": "audio_segment", "index": index, "text": text}
+        try:
+            frame.update(await task)
+        except Exception as e:
+            logger.error(f"Error synthesizing segment {index}: {str(e)}")
+            frame["error"] = f"Speech synthesis error: {str(e)}"
+        await send_with_audio(websocket, frame)
+        delivered.append(frame)
+
+async def stream_text_with_llm(websocket, text_input, tts_pipeline=TTS_PIPELINE, session=None):
+    """Stream LLM tokens to a WebSocket client, then send the full response.
+
+    With tts_pipeline enabled each completed sentence is sent to TTS while the
+    LLM is still generating, and the audio is delivered as ordered
+    audio_segment frames instead of one file for the whole reply.
+    """
+    # Simple device commands are answered without the LLM
+    response = await try_fast_path(text_input, session)
+    if response:
+        await websocket.send_json({"type": "token", "text": response["ai_response"]})
+        await send_with_audio(websocket, {"type": "response", **response})
+        return
+    
+    TURNS.labels("llm").inc()
+    tokens = []
+    stats = {}
+    started = time.perf_counter()
+    splitter = SentenceSplitter()
+    segments = asyncio.Queue()
+    segment_count = 0
+    delivery = asyncio.create_task(deliver_audio_segments(websocket, segments)) if tts_pipeline else None
+    
+    def schedule(sentences):
+        nonlocal segment_count
+        for sentence in sentences:
+            segments.put_nowait((segment_count, sentence, asyncio.create_task(synthesize_segment(sentence))))
+            segment_count += 1
+    
+    try:
+        async for chunk in stream_llm_chunks(text_input, session):
+            token = chunk.get("message", {}).get("content", "")
+            if token:
+                if not tokens:
+                    STAGE_SECONDS.labels("llm_first_token").observe(time.perf_counter() - started)
+                tokens.append(token)
+                await websocket.send_json({"type": "token", "text": token})
+                if delivery:
+                    schedule(splitter.feed(token))
+            if chunk.get("done"):
+                stats = {
+                    key: chunk[key]
+                    for key in ("total_duration", "load_duration", "prompt_eval_count",
+                                "prompt_eval_duration", "eval_count", "eval_duration", "queue_wait_ms")
+                    if key in chunk
+                }
+    except BaseException:
+        if delivery:
+            delivery.cancel()
+            while not segments.empty():
+                segments.get_nowait()[2].cancel()
+        raise
+    
+    if session:
+        session.add_turn(text_input, "".join(tokens))
+    
+    if delivery:
+        # Device commands run while the remaining sentences are synthesized and delivered
+        iot_stage = start_iot_stage(text_input, "".join(tokens))
+        schedule(splitter.flush())
+        segments.put_nowait(None)
+        audio_segments = await delivery
+        response = await complete_turn(
+            text_input, "".join(tokens), synthesize=False, websocket=websocket, iot_stage=iot_stage
+        )
+        if audio_transport_var.get() == "path":
+            response["audio_segments"] = [frame.get("audio_path", "") for frame in audio_segments]
     else:
-        iot_result = {"status": "no_commands"}
+        response = await complete_turn(text_input, "".join(tokens), websocket=websocket)
+    await send_with_audio(websocket, {"type": "response", **response, "llm_stats": stats})
+
+DEVICE_NAMES = {"light": "light", "fan": "fan", "ac": "air conditioner", "curtain": "curtains"}
+REPLY_TEMPLATES = {
+    "on": "turn on the {location} {name}",
+    "off": "turn off the {location} {name}",
+    "brighten": "brighten the {location} {name}",
+    "dim": "dim the {location} {name}",
+    "temp_up": "raise the {location} {name} temperature",
+    "temp_down": "lower the {location} {name} temperature",
+    "speed_up": "speed up the {location} {name}",
+    "speed_down": "slow down the {location} {name}",
+    "set_temperature": "set the {location} {name} to {value} degrees",
+    "set_brightness": "set the {location} {name} brightness to {value}%",
+    "set_speed": "set the {location} {name} to speed {value}"
+}
+CURTAIN_TEMPLATES = {
+    "on": "open the {location} {name}", "open": "open the {location} {name}",
+    "off": "close the {location} {name}", "close": "close the {location} {name}"
+}
+
+def match_fast_path(text_input):
+    """Return IoT commands if the utterance is an unambiguous device command, else None"""
+    if "?" in text_input or len(text_input.split()) > FAST_PATH_MAX_WORDS:
+        return None
+    intent = command_intent(text_input)
+    return (intent_matcher.commands(intent) or None) if intent else None
+
+def render_fast_path_reply(commands, iot_result):
+    """Templated confirmation for executed commands"""
+    results = iot_result.get("results", [])
+    done, failed = [], []
+    for index, cmd in enumerate(commands):
+        templates = CURTAIN_TEMPLATES if cmd["device"] == "curtain" else REPLY_TEMPLATES
+        phrase = templates.get(cmd["action"], REPLY_TEMPLATES["on"]).format(
+            location=cmd["location"],
+            name=DEVICE_NAMES.get(cmd["device"], cmd["device"]),
+            value=next(iter(cmd.get("parameters", {}).values()), "")
+        )
+        ok = index < len(results) and results[index].get("status") == "success"
+        (done if ok else failed).append(phrase)
     
-    # 3. Determine expression/emotion
+    reply = []
+    if done:
+        reply.append(f"Okay, I'll {' and '.join(done)}.")
+    if failed:
+        reply.append(f"Sorry, I couldn't {' or '.join(failed)}.")
+    return " ".join(reply)
+
+async def try_fast_path(text_input, session=None):
+    """Execute a high-confidence device command directly and answer from a template"""
+    if not FAST_PATH_ENABLED:
+        return None
+    commands = match_fast_path(text_input)
+    if not commands:
+        return None
+    
+    TURNS.labels("fast_path").inc()
+    iot_result = await run_stage("IoT control", control_devices(commands), IOT_STAGE_TIMEOUT, {"status": "error"})
+    
+    ai_text_response = render_fast_path_reply(commands, iot_result)
+    if session:
+        session.add_turn(text_input, ai_text_response)
+    
+    # The commands have already run, so a TTS failure still returns the text reply.
+    # Templated replies repeat, so this is normally served from the TTS cache.
+    audio = await run_stage(
+        "Speech synthesis", synthesize_reply(ai_text_response), TTS_STAGE_TIMEOUT, {"audio_path": ""}
+    )
+    
+    response = {
+        "input_text": text_input,
+        "ai_response": ai_text_response,
+        **audio,
+        "expression": determine_expression(text_input, ai_text_response),
+        "iot_commands": commands,
+        "iot_result": iot_result,
+        "fast_path": True
+    }
+    if "audio" not in audio and not audio["audio_path"]:
+        response["error"] = "Speech synthesis failed"
+    return response
+
+async def control_devices(iot_commands):
+    """IoT stage: send commands to the IoT control service"""
+    if not iot_commands:
+        return {"status": "no_commands"}
+    with timed("iot_control"):
+        async with iot_client.request("POST", "/control", json={"commands": iot_commands}) as iot_response:
+            return await iot_response.json() if iot_response.status == 200 else {"status": "error"}
+
+async def synthesize_reply(ai_text_response):
+    """TTS stage: synthesize the whole reply and return its audio fields"""
+    with timed("tts"):
+        return await synthesize_audio(ai_text_response)
+
+async def run_stage(name, coro, timeout, fallback):
+    """Run one post-LLM stage with a timeout; failures yield the fallback instead of failing the turn"""
+    try:
+        return await asyncio.wait_for(coro, timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"{name} stage timed out after {timeout} s")
+        return {**fallback, "error": f"{name} timed out"} if isinstance(fallback, dict) else fallback
+    except Exception as e:
+        logger.error(f"{name} stage failed: {str(e)}")
+        return {**fallback, "error": f"{name} failed: {str(e)}"} if isinstance(fallback, dict) else fallback
+
+async def send_iot_followup(websocket, iot_commands, iot_task):
+    """Deliver the IoT result to a WebSocket client once it is ready"""
+    iot_result = await iot_task
+    try:
+        await websocket.send_json({"type": "iot_result", "iot_commands": iot_commands, "iot_result": iot_result})
+    except Exception as e:
+        logger.error(f"Error sending IoT result: {str(e)}")
+
+def start_iot_stage(text_input, ai_text_response):
+    """Extract IoT commands from a finished reply and start sending them; returns (commands, task)"""
+    iot_commands = extract_iot_commands(text_input, ai_text_response)
+    # Held in background_tasks too, so the commands still go out if the caller fails before awaiting it
+    return iot_commands, start_background_task(run_stage(
+        "IoT control", control_devices(iot_commands), IOT_STAGE_TIMEOUT, {"status": "error"}
+    ))
+
+async def complete_turn(text_input, ai_text_response, synthesize=True, websocket=None, iot_stage=None):
+    """Run the post-LLM stages (IoT control, expression, TTS) for a finished reply.
+
+    IoT control and TTS run concurrently, each with its own timeout. For
+    WebSocket clients the reply is returned as soon as the audio is ready; an
+    IoT result that is still pending follows as a separate iot_result frame.
+    Pass iot_stage from start_iot_stage when IoT control was started earlier.
+    """
+    # 2. Check if IoT control is needed and start it
+    iot_commands, iot_task = iot_stage or start_iot_stage(text_input, ai_text_response)
+    
+    # 3. Start speech synthesis of the AI reply alongside it
+    tts_task = None
+    if synthesize:
+        tts_task = asyncio.create_task(run_stage(
+            "Speech synthesis", synthesize_reply(ai_text_response), TTS_STAGE_TIMEOUT, {"audio_path": ""}
+        ))
+    
+    # 4. Determine expression/emotion while the stages run
     expression = determine_expression(text_input, ai_text_response)
     
-    # 4. Send AI reply to TTS to generate speech
-    tts_url = f"http://{TTS_HOST}:{TTS_PORT}/synthesize"
-    tts_response = requests.post(tts_url, json={"text": ai_text_response})
-    tts_response.raise_for_status()
+    audio = await tts_task if tts_task else {"audio_path": ""}
     
-    audio_file_path = tts_response.json().get("audio_path", "")
+    if websocket is not None and not iot_task.done():
+        start_background_task(send_iot_followup(websocket, iot_commands, iot_task))
+        iot_result = {"status": "pending"}
+    else:
+        iot_result = await iot_task
     
     # Return complete response
-    return {
+    response = {
         "input_text": text_input,
         "ai_response": ai_text_response,
-        "audio_path": audio_file_path,
+        "audio_path": audio["audio_path"],
         "expression": expression,
         "iot_commands": iot_commands,
         "iot_result": iot_result
     }
+    if "audio" in audio:
+        response["audio"] = audio["audio"]
+        response["audio_format"] = audio["audio_format"]
+    elif synthesize and not audio["audio_path"]:
+        response["error"] = "Speech synthesis failed"
+    return response
+
+# Kept byte-for-byte identical across turns so Ollama can reuse its KV cache for it;
+# the changing device status is sent in separate messages kept in the history.
+SYSTEM_PROMPT = """You are a friendly AI voice assistant, capable of answering questions and controlling smart home devices. If a user requests to control a device, please clearly state the action you will perform in your response, for example, "Okay, I'll turn on/off the living room light."
 
-def add_system_instructions(user_input):
-    """Add system instructions to user input"""
-    # First, get current device status
+Controllable devices include:
+- Lights (on/off/brighten/dim)
+- Fans (on/off/speed)
+- Air conditioners (on/off/temperature/mode)
+- Curtains (open/close)
+
+Please maintain a brief, friendly response style and accurately understand the user's control intentions. When asked about device status, provide the current status from the latest device status message."""
+
+class ConversationSession:
+    """Rolling chat history for one client, bounded by an estimated token budget.
+
+    Device status messages stay in the history where they were sent, and a new
+    one is only added when the status changed, so every prompt extends the
+    previous prompt plus its reply and Ollama can reuse its KV cache for all of it.
+    """
+
+    def __init__(self, max_tokens=OLLAMA_HISTORY_TOKENS):
+        self.max_tokens = max_tokens
+        self.turns = []  # Lists of messages: [device status], user, assistant
+        self.tokens = 0
+        self.status = None  # Latest device status message in the history
+        self.pending_status = None  # Status message sent with the turn in progress
+
+    @property
+    def history(self):
+        return [message for turn in self.turns for message in turn]
+
+    @staticmethod
+    def estimate_tokens(message):
+        # Roughly four characters per token plus per-message overhead
+        return len(message["content"]) // 4 + 4
+
+    def status_update(self, status_message):
+        """Messages to send before the next user input: the status, unless the history already has it"""
+        self.pending_status = None if status_message == self.status else status_message
+        return [self.pending_status] if self.pending_status else []
+
+    def add_turn(self, user_input, ai_response):
+        turn = [self.pending_status] if self.pending_status else []
+        if self.pending_status:
+            self.status = self.pending_status
+            self.pending_status = None
+        turn += [{"role": "user", "content": user_input},
+                 {"role": "assistant", "content": ai_response}]
+        self.turns.append(turn)
+        self.tokens += sum(self.estimate_tokens(message) for message in turn)
+        
+        # Drop whole turns from the front; the oldest kept turn inherits the last dropped status
+        carried = None
+        while self.tokens > self.max_tokens and len(self.turns) > 1:
+            dropped = self.turns.pop(0)
+            self.tokens -= sum(self.estimate_tokens(message) for message in dropped)
+            if dropped[0]["role"] == "system":
+                carried = dropped[0]
+        if carried and self.turns[0][0]["role"] != "system":
+            self.turns[0].insert(0, carried)
+            self.tokens += self.estimate_tokens(carried)
+
+async def build_chat_messages(user_input, session=None):
+    """Build the /api/chat message list: stable system prompt, history, device status if changed, user input"""
+    # Current device status comes from the local mirror
     try:
-        iot_url = f"http://{IOT_HOST}:{IOT_PORT}/devices"
-        iot_response = requests.get(iot_url)
-        if iot_response.status_code == 200:
-            device_states = iot_response.json().get("devices", {})
-            # Convert device states to human readable format
-            device_status_text = format_device_states(device_states)
-        else:
-            device_status_text = "Unable to retrieve current device status."
+        device_status_text = await device_mirror.get_status_text()
     except Exception as e:
         logger.error(f"Error getting device status: {str(e)}")
         device_status_text = "Unable to retrieve current device status due to an error."
     
-    system_prompt = f"""You are a friendly AI voice assistant, capable of answering questions and controlling smart home devices. If a user requests to control a device, please clearly state the action you will perform in your response, for example, "Okay, I'll turn on/off the living room light."
-    
-    Current device status:
-    {device_status_text}
-    
-    Controllable devices include:
-    - Lights (on/off/brighten/dim)
-    - Fans (on/off/speed)
-    - Air conditioners (on/off/temperature/mode)
-    - Curtains (open/close)
-    
-    Please maintain a brief, friendly response style and accurately understand the user's control intentions. When asked about device status, provide the current status from the information above.
-    """
-    return f"{system_prompt}\n\nUser: {user_input}\nAssistant:"
+    status_message = {"role": "system", "content": f"Current device status:\n{device_status_text}"}
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        *(session.history if session else []),
+        *(session.status_update(status_message) if session else [status_message]),
+        {"role": "user", "content": user_input}
+    ]
 
 def format_device_states(device_states):
     """Format device states into human-readable text"""
@@ -208,71 +1054,179 @@ def format_device_states(device_states):
     
     return "\n".join(result)
 
-def extract_iot_commands(user_input, ai_response):
-    """Extract IoT control commands from user input and AI response"""
-    # Simple keyword matching, can use more complex NLU in practice
-    commands = []
-    
-    # Check keywords
-    keywords = {
-        "light": "light",
-        "lights": "light",
-        "lamp": "light",
-        "fan": "fan",
-        "air conditioner": "ac",
-        "ac": "ac",
-        "curtain": "curtain",
-        "curtains": "curtain"
-    }
-    
-    actions = {
-        "on": "on",
-        "turn on": "on",
-        "off": "off",
-        "turn off": "off",
-        "brighten": "brighten",
-        "dim": "dim",
-        "increase temperature": "temp_up",
-        "decrease temperature": "temp_down"
-    }
-    
-    # Location keywords
-    locations = ["living room", "bedroom", "kitchen", "study"]
-    
-    for keyword, device in keywords.items():
-        if keyword in user_input.lower():
-            # Determine location
-            location = "living room"  # Default location
-            for loc in locations:
-                if loc in user_input.lower():
-                    location = loc
-                    break
-            
-            # Determine action
-            action = "on"  # Default action
-            for act_key, act_val in actions.items():
-                if act_key in user_input.lower():
-                    action = act_val
-                    break
+# Phrase tables for the intent matcher. Device types and locations are
+# extended from the IoT service's device catalog when it is available.
+DEVICE_SYNONYMS = {
+    "light": ["light", "lights", "lamp", "lamps"],
+    "fan": ["fan", "fans"],
+    "ac": ["ac", "a/c", "air conditioner", "air conditioning", "aircon"],
+    "curtain": ["curtain", "curtains", "blinds"]
+}
+ACTION_PHRASES = {
+    "turn on": "on", "switch on": "on", "on": "on",
+    "turn off": "off", "switch off": "off", "off": "off",
+    "open": "open", "close": "close",
+    "brighten": "brighten", "brighter": "brighten",
+    "dim": "dim", "dimmer": "dim",
+    "increase temperature": "temp_up", "warmer": "temp_up",
+    "decrease temperature": "temp_down", "cooler": "temp_down",
+    "speed up": "speed_up", "faster": "speed_up",
+    "slow down": "speed_down", "slower": "speed_down",
+    "set": "set"
+}
+DEFAULT_LOCATIONS = ["living room", "bedroom", "kitchen", "study"]
+CUE_PHRASES = {
+    "thanks": ["thank", "thanks", "thank you", "grateful"],
+    "question": ["what", "how", "why", "explain"],
+    "apology": ["sorry", "apologize", "regret"],
+    "surprise": ["surprise", "wow", "amazing"],
+    # Words that make an utterance a query, a scheduled or a negated request rather than a plain command
+    "query": ["what", "what's", "how", "why", "when", "which", "who", "is", "are", "does", "do",
+              "can", "could", "would", "should", "status", "if"],
+    "schedule": ["then", "after", "before", "minute", "minutes", "second", "seconds",
+                 "hour", "hours", "tomorrow", "tonight"],
+    "negation": ["don't", "dont", "do not", "doesn't", "not", "never", "no", "stop", "cancel",
+                 "undo", "nevermind", "never mind"]
+}
+
+class IntentMatcher:
+    """Single-pass phrase matcher for device commands and expression cues.
+
+    All phrases are compiled once into one word-boundary regex (longest
+    phrase first), so parsing is a single scan of the lower-cased text no
+    matter how many devices the catalog holds, and short keywords like "ac"
+    or "on" no longer match inside "back" or "phone".
+    """
+
+    def __init__(self, device_types=(), locations=DEFAULT_LOCATIONS):
+        self.phrases = {}  # phrase -> [(slot, value)]
+        for device in set(DEVICE_SYNONYMS) | set(device_types):
+            for phrase in DEVICE_SYNONYMS.get(device, [device, f"{device}s"]):
+                self._add(phrase, "device", device)
+        for phrase, action in ACTION_PHRASES.items():
+            self._add(phrase, "action", action)
+        for location in locations:
+            self._add(location, "location", location)
+        for cue, phrases in CUE_PHRASES.items():
+            for phrase in phrases:
+                self._add(phrase, "cue", cue)
+        
+        alternation = "|".join(re.escape(phrase) for phrase in sorted(self.phrases, key=len, reverse=True))
+        self.pattern = re.compile(rf"(?<![\w/])({alternation})(?![\w/])|(\d+(?:\.\d+)?)")
+        self.default_location = "living room" if "living room" in locations else next(iter(locations), "living room")
+
+    def _add(self, phrase, slot, value):
+        self.phrases.setdefault(phrase, []).append((slot, value))
+
+    def parse(self, text):
+        """Return device/action/location/number slots and cues found in text"""
+        intent = {"devices": [], "actions": [], "locations": [], "numbers": [], "cues": set()}
+        for position, match in enumerate(self.pattern.finditer(text.lower())):
+            if match.group(2):
+                intent["numbers"].append((position, float(match.group(2))))
+                continue
+            for slot, value in self.phrases[match.group(1)]:
+                if slot == "cue":
+                    intent["cues"].add(value)
+                    # "5 minutes" is a delay, not a setting
+                    if value == "schedule" and intent["numbers"] and intent["numbers"][-1][0] == position - 1:
+                        intent["numbers"].pop()
+                else:
+                    intent[f"{slot}s"].append((position, value))
+        return intent
+
+    def commands(self, intent):
+        """Turn parsed slots into IoT commands, pairing each device with its nearest location and action.
+
+        A device mentioned without any action phrase is not a command.
+        """
+        commands = []
+        if not intent["actions"]:
+            return commands
+        for position, device in intent["devices"]:
+            location = self._nearest(intent["locations"], position) or self.default_location
+            action = self._nearest(intent["actions"], position, prefer_before=True)
+            number = self._nearest(intent["numbers"], position)
             
-            commands.append({
-                "device": device,
-                "action": action,
-                "location": location
-            })
-    
-    return commands
+            command = {"device": device, "action": self._resolve_action(device, action, number), "location": location}
+            if number is not None and command["action"].startswith("set_"):
+                parameter = command["action"][len("set_"):]
+                command["parameters"] = {parameter: int(number) if number.is_integer() else number}
+            if command not in commands:
+                commands.append(command)
+        return commands
+
+    @staticmethod
+    def _nearest(slots, position, prefer_before=False):
+        if not slots:
+            return None
+        if prefer_before:
+            before = [slot for slot in slots if slot[0] < position]
+            if before:
+                return before[-1][1]
+        return min(slots, key=lambda slot: abs(slot[0] - position))[1]
+
+    @staticmethod
+    def _resolve_action(device, action, number):
+        if action in ("open", "close"):
+            if device == "curtain":
+                return action
+            return "on" if action == "open" else "off"
+        if number is not None and action in ("set", "on"):
+            return {"ac": "set_temperature", "light": "set_brightness", "fan": "set_speed"}.get(device, action)
+        return "on" if action == "set" else action
+
+intent_matcher = IntentMatcher()
+
+def rebuild_intent_matcher(device_states):
+    """Rebuild the matcher from the IoT device catalog (device types and their locations)"""
+    global intent_matcher
+    locations = sorted({location for states in device_states.values() for location in states})
+    intent_matcher = IntentMatcher(device_states.keys(), locations or DEFAULT_LOCATIONS)
+    logger.info(f"Intent matcher rebuilt: {len(device_states)} device types, {len(locations)} locations")
+
+# Cues that mean an utterance is not a device command to carry out right now
+NON_COMMAND_CUES = {"query", "schedule", "negation"}
+
+def command_intent(text):
+    """Parsed intent of text if it is a plain device command (an action phrase, no query/schedule/negation cue), else None"""
+    intent = intent_matcher.parse(text)
+    if not intent["actions"] or intent["cues"] & NON_COMMAND_CUES:
+        return None
+    return intent
+
+# The reply's own statement of what it will do, as the system prompt asks for
+CONFIRMATION_PATTERN = re.compile(r"\bI(?:'ll| will)\b[^.!?\n]*", re.IGNORECASE)
+
+def extract_iot_commands(user_input, ai_response):
+    """Extract IoT control commands from user input and AI response.
+
+    Negated or scheduled requests never act. Questions and polite requests
+    ("could you turn on the fan") only act on what the reply confirms
+    ("Okay, I'll turn on the fan"); plain commands act as said.
+    """
+    intent = intent_matcher.parse(user_input)
+    if intent["cues"] & {"negation", "schedule"}:
+        return []
+    if "query" in intent["cues"]:
+        commands = []
+        for clause in CONFIRMATION_PATTERN.findall(ai_response):
+            confirmed = command_intent(clause)
+            if confirmed:
+                commands += [command for command in intent_matcher.commands(confirmed) if command not in commands]
+        return commands
+    return intent_matcher.commands(intent)
 
 def determine_expression(user_input, ai_response):
     """Determine expression/emotion based on conversation content"""
-    # Simple keyword matching
-    if any(word in user_input.lower() for word in ["thank", "thanks", "grateful"]):
+    user_cues = intent_matcher.parse(user_input)["cues"]
+    if "thanks" in user_cues:
         return "smile"
-    elif any(word in user_input.lower() for word in ["what", "how", "why", "explain"]):
+    elif "question" in user_cues:
         return "thinking"
-    elif any(word in ai_response.lower() for word in ["sorry", "apologize", "regret"]):
+    elif "apology" in intent_matcher.parse(ai_response)["cues"]:
         return "sad"
-    elif any(word in user_input.lower() for word in ["surprise", "wow", "amazing"]):
+    elif "surprise" in user_cues:
         return "surprised"
     else:
         return "neutral"
@@ -283,30 +1237,75 @@ async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
     client_id = id(websocket)
     connected_clients[client_id] = websocket
+    WS_CLIENTS.inc()
+    current_client.set(client_id)
+    session = ConversationSession()
+    pending_audio = None  # "audio" message waiting for the binary frame that carries the recording
     
     try:
         while True:
-            data = await websocket.receive_text()
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
             try:
-                message = json.loads(data)
+                audio = frame.get("bytes")
+                if audio is not None:
+                    # Recording sent inline, described by the preceding "audio" message if any
+                    message, pending_audio = pending_audio or {"type": "audio"}, None
+                else:
+                    message = json.loads(frame["text"])
                 message_type = message.get("type")
+                if message_type == "audio" and audio is None:
+                    pending_audio = message
+                    continue
+                
+                # Each message is its own turn; clients may supply the correlation ID
+                request_id_var.set(str(message.get("request_id") or uuid.uuid4().hex))
+                select_audio_transport(message.get("audio_transport"))
                 
                 if message_type == "text":
                     # Process text message
-                    response = await process_text_with_llm(message.get("text", ""))
-                    await websocket.send_json(response)
+                    with timed("turn"):
+                        if message.get("stream"):
+                            await stream_text_with_llm(websocket, message.get("text", ""),
+                                                       message.get("tts_pipeline", TTS_PIPELINE), session)
+                        else:
+                            response = await process_text_with_llm(message.get("text", ""), session, websocket)
+                            await send_with_audio(websocket, response)
+                
+                elif message_type in ("audio", "audio_ready"):
+                    # Process a recording sent inline, or the path of one on the shared volume
+                    with timed("turn"):
+                        if message_type == "audio":
+                            transcription = await transcribe_audio_bytes(audio, message.get("content_type", ""))
+                        else:
+                            transcription = await transcribe_audio(message.get("path"))
+                        if not transcription:
+                            await websocket.send_json({"type": "error", "error": "Unable to recognize audio content"})
+                        elif message.get("stream"):
+                            await stream_text_with_llm(websocket, transcription,
+                                                       message.get("tts_pipeline", TTS_PIPELINE), session)
+                        else:
+                            response = await process_text_with_llm(transcription, session, websocket)
+                            await send_with_audio(websocket, response)
                 
-                elif message_type == "audio_ready":
-                    # Process audio ready notification
-                    audio_path = message.get("path")
-                    response = await process_audio(AudioRequest(audio_path=audio_path))
-                    await websocket.send_json(response)
+                elif message_type == "reset":
+                    # Start a new conversation
+                    session = ConversationSession()
+                    await websocket.send_json({"type": "reset", "status": "ok"})
                 
                 else:
                     await websocket.send_json({"error": "Unknown message type"})
             
             except json.JSONDecodeError:
                 await websocket.send_json({"error": "Invalid JSON format"})
+            
+            except WebSocketDisconnect:
+                raise
+            
+            except Exception as e:
+                logger.error(f"Error processing WebSocket message: {str(e)}")
+                await websocket.send_json({"type": "error", "error": f"Error processing request: {str(e)}"})
     
     except WebSocketDisconnect:
         if client_id in connected_clients:
@@ -316,6 +1315,9 @@ async def websocket_endpoint(websocket: WebSocket):
         logger.error(f"WebSocket error: {str(e)}")
         if client_id in connected_clients:
             del connected_clients[client_id]
+    
+    finally:
+        WS_CLIENTS.dec()
 
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8080, reload=True)
\ No newline at end of file
@@ -3,20 +3,52 @@ import logging
 import json
 import time
 import asyncio
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse
+import uuid
+import contextvars
+from contextlib import contextmanager
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import uvicorn
 from pydantic import BaseModel
+import paho.mqtt.client as mqtt
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
 from typing import List, Dict, Any, Optional
 
+# Correlation ID of the request being handled (X-Request-ID), added to log lines
+request_id_var = contextvars.ContextVar("request_id", default="-")
+_record_factory = logging.getLogRecordFactory()
+
+def record_with_request_id(*args, **kwargs):
+    record = _record_factory(*args, **kwargs)
+    record.request_id = request_id_var.get()
+    return record
+
+logging.setLogRecordFactory(record_with_request_id)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+# Prometheus metrics, served at /metrics
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGE_SECONDS = Histogram("voice_stage_duration_seconds", "Time spent in each stage of a voice turn",
+                          ["stage"], buckets=STAGE_BUCKETS)
+COMMANDS = Counter("voice_iot_commands_total", "Device commands handled, by device and result", ["device", "status"])
+MQTT_FAILURES = Counter("voice_iot_mqtt_failures_total", "MQTT publishes that failed")
+
+@contextmanager
+def timed(stage):
+    """Record how long the block takes under the given stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
 # Environment variables
 CONFIG_PATH = os.getenv("CONFIG_PATH", "/app/config/devices.json")
 MQTT_ENABLED = os.getenv("MQTT_ENABLED", "false").lower() == "true"
@@ -24,6 +56,9 @@ MQTT_BROKER = os.getenv("MQTT_BROKER", "mqtt_broker")
 MQTT_PORT = int(os.getenv("MQTT_PORT", 1883))
 MQTT_USER = os.getenv("MQTT_USER", "")
 MQTT_PASSWORD = os.getenv("MQTT_PASSWORD", "")
+MQTT_QOS = int(os.getenv("MQTT_QOS", 1))  # 1 or 2: results report the broker's acknowledgement; 0: only that it was sent
+MQTT_ACK_TIMEOUT = float(os.getenv("MQTT_ACK_TIMEOUT", 2))  # Seconds to wait for acknowledgements before reporting a timeout; keep below the coordinator's IOT_TIMEOUT
+MQTT_MAX_QUEUED = int(os.getenv("MQTT_MAX_QUEUED", 100))  # Messages paho may hold unacknowledged before publishes are refused
 
 # Create FastAPI application
 app = FastAPI(title="IoT Control Service")
@@ -35,10 +70,21 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
+@app.middleware("http")
+async def correlation_id_middleware(request: Request, call_next):
+    """Tag the request with the caller's X-Request-ID, or a new one, and echo it back"""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
 # Connected ESP32 devices
 connected_devices = {}
+Gauge("voice_websocket_clients", "Connected WebSocket clients").set_function(lambda: len(connected_devices))
 
 # Device states
 device_states = {
@@ -75,6 +121,18 @@ class IoTControlRequest(BaseModel):
 async def root():
     return {"message": "IoT Control Service is running"}
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/mqtt/stats")
+async def mqtt_stats():
+    """Get MQTT connection and delivery statistics"""
+    if not mqtt_publisher:
+        return {"enabled": False}
+    return mqtt_publisher.stats()
+
 @app.get("/devices")
 async def get_devices():
     """Get all device states"""
@@ -99,6 +157,7 @@ async def get_device_status(device_type: str, location: str):
 async def control_devices(request: IoTControlRequest):
     """Control IoT devices"""
     results = []
+    mqtt_messages = []  # (result, (topic, payload)) for commands to publish
     
     for cmd in request.commands:
         try:
@@ -125,12 +184,14 @@ async def control_devices(request: IoTControlRequest):
                 continue
             
             # Execute control command
-            result = await execute_command(device, action, location, parameters)
+            with timed("iot_execute"):
+                result = await execute_command(device, action, location, parameters)
             results.append(result)
+            COMMANDS.labels(device, result["status"]).inc()
             
-            # If MQTT is enabled, send control command
-            if MQTT_ENABLED:
-                await send_mqtt_command(device, action, location, parameters)
+            # If MQTT is enabled, queue the control command for this request's batch
+            if mqtt_publisher and result["status"] == "success":
+                mqtt_messages.append((result, mqtt_command_message(device, action, location, parameters)))
             
         except Exception as e:
             logger.error(f"Error executing command: {str(e)}")
@@ -140,6 +201,17 @@ async def control_devices(request: IoTControlRequest):
                 "command": cmd
             })
     
+    # Publish all of this request's commands together and report each acknowledgement
+    if mqtt_messages:
+        with timed("mqtt_publish"):
+            deliveries = await mqtt_publisher.publish_batch([message for _, message in mqtt_messages])
+        for (result, _), delivery in zip(mqtt_messages, deliveries):
+            result["mqtt"] = delivery
+            # The command only counts as done once it reached the device
+            if delivery["status"] in ("timeout", "error"):
+                result["status"] = "error"
+                result["message"] = f"MQTT delivery failed: {delivery['message']}"
+    
     return {"results": results}
 
 async def execute_command(device, action, location, parameters):
@@ -258,39 +330,170 @@ async def broadcast_device_update(device, location):
         except Exception as e:
             logger.error(f"WebSocket send failed: {str(e)}")
 
-async def send_mqtt_command(device, action, location, parameters):
-    """Send device control command via MQTT"""
-    if not MQTT_ENABLED:
-        return
-    
-    try:
-        import paho.mqtt.client as mqtt
-        
-        # MQTT configuration
-        client = mqtt.Client()
+def mqtt_command_message(device, action, location, parameters):
+    """Build the MQTT topic and JSON payload for a device control command"""
+    topic = f"iot/{device}/{location}"
+    timestamp = time.time()
+    payload = {
+        "action": action,
+        "parameters": parameters,
+        "timestamp": timestamp,
+        # The request reports the command as failed after this; devices must ignore it once expired
+        "expires_at": timestamp + MQTT_ACK_TIMEOUT,
+        "request_id": request_id_var.get()
+    }
+    return topic, json.dumps(payload)
+
+class MqttPublisher:
+    """Persistent MQTT connection shared by all requests.
+
+    paho runs the network loop on its own thread (loop_start) and reconnects
+    with backoff whenever the connection drops. Requests queue their messages
+    as one batch; a sender task publishes each batch back to back, and every
+    message resolves once the broker acknowledges it (PUBACK for QoS 1,
+    PUBCOMP for QoS 2, or as soon as it is written for QoS 0). paho calls
+    on_publish on its own thread, so acknowledgements are handed to the event
+    loop with call_soon_threadsafe. Publishes fail fast while disconnected. paho
+    still resends a QoS 1/2 message whose acknowledgement timed out after a
+    reconnect, so such a result says the command may still be delivered; the
+    payload's expires_at lets devices ignore it by then.
+    """
+
+    def __init__(self, host, port, qos, ack_timeout):
+        self.host = host
+        self.port = port
+        self.qos = qos
+        self.ack_timeout = ack_timeout
+        self.client = mqtt.Client(client_id=f"iot-control-{uuid.uuid4().hex[:8]}")
         if MQTT_USER and MQTT_PASSWORD:
-            client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
-        
-        # Create message
-        topic = f"iot/{device}/{location}"
-        payload = {
-            "action": action,
-            "parameters": parameters,
-            "timestamp": time.time()
-        }
-        
-        # Convert to JSON
-        message = json.dumps(payload)
+            self.client.username_pw_set(MQTT_USER, MQTT_PASSWORD)
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.client.max_queued_messages_set(MQTT_MAX_QUEUED)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.loop = None
+        self.sender = None
+        self.queue = asyncio.Queue()
+        self.pending = {}  # mid -> (future, time published)
+        self.connected = False
+        self.connects = 0
+        self.published = 0
+        self.acked = 0
+        self.failed = 0
+
+    def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.client.connect_async(self.host, self.port, keepalive=60)
+        self.client.loop_start()
+        self.sender = asyncio.create_task(self._send_batches())
+
+    def stop(self):
+        if self.sender:
+            self.sender.cancel()
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    # paho callbacks, called on the network thread
+    def _on_connect(self, client, userdata, flags, rc):
+        if rc == 0:
+            logger.info(f"MQTT connected to {self.host}:{self.port}")
+        else:
+            logger.error(f"MQTT connection refused: {mqtt.connack_string(rc)}")
+        self.loop.call_soon_threadsafe(self._set_connected, rc == 0)
+
+    def _on_disconnect(self, client, userdata, rc):
+        if rc != 0:
+            logger.warning(f"MQTT connection lost ({mqtt.error_string(rc)}), reconnecting")
+        self.loop.call_soon_threadsafe(self._set_connected, False)
+
+    def _on_publish(self, client, userdata, mid):
+        self.loop.call_soon_threadsafe(self._acknowledge, mid)
+
+    def _set_connected(self, connected):
+        if connected:
+            self.connects += 1
+        self.connected = connected
+
+    def _acknowledge(self, mid):
+        # Runs after the sender registered mid, since both happen on the event loop
+        entry = self.pending.pop(mid, None)
+        if entry and not entry[0].done():
+            entry[0].set_result(round((time.perf_counter() - entry[1]) * 1000, 1))
+
+    async def _send_batches(self):
+        while True:
+            batch = await self.queue.get()
+            for topic, payload, future in batch:
+                if future.done():
+                    # The request stopped waiting while this was queued
+                    continue
+                if not self.connected:
+                    future.set_exception(ConnectionError("not connected to the MQTT broker"))
+                    continue
+                try:
+                    info = self.client.publish(topic, payload, qos=self.qos)
+                except ValueError as e:
+                    future.set_exception(e)
+                    continue
+                if info.rc == mqtt.MQTT_ERR_SUCCESS:
+                    self.pending[info.mid] = (future, time.perf_counter())
+                    self.published += 1
+                elif info.rc == mqtt.MQTT_ERR_NO_CONN and self.qos > 0:
+                    # The connection dropped just now; paho keeps the message for the reconnect
+                    future.set_exception(ConnectionError(
+                        f"{mqtt.error_string(info.rc)}; may still be delivered before it expires"))
+                else:
+                    future.set_exception(ConnectionError(mqtt.error_string(info.rc)))
+
+    async def publish_batch(self, messages):
+        """Publish (topic, payload) pairs together and return each one's delivery result"""
+        futures = [self.loop.create_future() for _ in messages]
+        self.queue.put_nowait([(topic, payload, future) for (topic, payload), future in zip(messages, futures)])
+        done, _ = await asyncio.wait(futures, timeout=self.ack_timeout)
         
-        # Connect and publish
-        client.connect(MQTT_BROKER, MQTT_PORT, 60)
-        client.publish(topic, message)
-        client.disconnect()
+        results = []
+        for (topic, _), future in zip(messages, futures):
+            if future not in done:
+                future.cancel()
+                result = {"topic": topic, "status": "timeout",
+                          "message": "no acknowledgement; may still be delivered before it expires"}
+            elif future.exception():
+                result = {"topic": topic, "status": "error", "message": str(future.exception())}
+            else:
+                result = {"topic": topic, "status": "acked" if self.qos else "sent", "ack_ms": future.result()}
+                self.acked += 1
+            if result["status"] in ("timeout", "error"):
+                self.failed += 1
+                MQTT_FAILURES.inc()
+                logger.error(f"MQTT publish to {topic} failed: {result['message']}")
+            results.append(result)
         
-        logger.info(f"MQTT command sent: {topic} - {message}")
-    
-    except Exception as e:
-        logger.error(f"MQTT send failed: {str(e)}")
+        # Forget messages that will never be waited for again
+        for mid, (future, _) in list(self.pending.items()):
+            if future.done():
+                del self.pending[mid]
+        return results
+
+    def stats(self):
+        return {
+            "enabled": True,
+            "connected": self.connected,
+            "broker": f"{self.host}:{self.port}",
+            "qos": self.qos,
+            "connects": self.connects,
+            "published": self.published,
+            "acked": self.acked,
+            "failed": self.failed,
+            "awaiting_ack": len(self.pending),
+            "queued_batches": self.queue.qsize()
+        }
+
+mqtt_publisher = MqttPublisher(MQTT_BROKER, MQTT_PORT, MQTT_QOS, MQTT_ACK_TIMEOUT) if MQTT_ENABLED else None
+if mqtt_publisher:
+    Gauge("voice_iot_mqtt_connected", "Whether the MQTT connection is up").set_function(lambda: mqtt_publisher.connected)
+    Gauge("voice_iot_mqtt_awaiting_ack", "MQTT messages published but not yet acknowledged").set_function(
+        lambda: len(mqtt_publisher.pending))
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -395,6 +598,16 @@ async def startup_event():
     """Event handler for application startup"""
     # Start simulation task
     asyncio.create_task(simulate_device_updates())
+    
+    # Connect to the MQTT broker once; paho keeps the connection up from here
+    if mqtt_publisher:
+        mqtt_publisher.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Event handler for application shutdown"""
+    if mqtt_publisher:
+        mqtt_publisher.stop()
 
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8002, reload=False)
\ No newline at end of file
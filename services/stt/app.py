@@ -1,38 +1,588 @@
 import os
+import json
 import logging
 import asyncio
 import socket
 import time
+import io
 import wave
+import queue
+import struct
+import subprocess
+import threading
+import uuid
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from fastapi import FastAPI, UploadFile, File, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 import numpy as np
 import uvicorn
 from pydantic import BaseModel
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+import torch
 import whisper
 
+# Correlation ID of the request being handled (X-Request-ID), added to log lines
+request_id_var = contextvars.ContextVar("request_id", default="-")
+_record_factory = logging.getLogRecordFactory()
+
+def record_with_request_id(*args, **kwargs):
+    record = _record_factory(*args, **kwargs)
+    record.request_id = request_id_var.get()
+    return record
+
+logging.setLogRecordFactory(record_with_request_id)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+# Prometheus metrics, served at /metrics
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGE_SECONDS = Histogram("voice_stage_duration_seconds", "Time spent in each stage of a voice turn",
+                          ["stage"], buckets=STAGE_BUCKETS)
+STT_REJECTED = Counter("voice_stt_rejected_total", "Transcriptions refused because inference was unavailable", ["reason"])
+STT_BATCH_SIZE = Histogram("voice_stt_batch_size", "Utterances decoded per inference call", buckets=(1, 2, 4, 8, 16, 32))
+UDP_PACKETS = Counter("voice_udp_packets_total", "UDP audio packets by outcome", ["outcome"])
+UDP_RECORDINGS = Counter("voice_udp_recordings_total", "UDP recordings finished, by reason", ["reason"])
+
+@contextmanager
+def timed(stage):
+    """Record how long the block takes under the given stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+# Fire-and-forget tasks; the event loop only keeps weak references to tasks,
+# so they are held here until they finish
+background_tasks = set()
+
+def start_background_task(coro):
+    """Run a coroutine as a task that nobody awaits, keeping it referenced until done"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 # Environment variables
 WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base")
 AUDIO_DIR = os.getenv("AUDIO_DIR", "/app/audio")
 UDP_PORT = int(os.getenv("UDP_PORT", 8000))
 SAMPLE_RATE = 16000  # ESP32 recording sample rate
+STT_WORKERS = int(os.getenv("STT_WORKERS", max(1, (os.cpu_count() or 1) // 2)))  # Parallel inference workers
+STT_MAX_QUEUE = int(os.getenv("STT_MAX_QUEUE", 16))  # Requests allowed to wait for a free worker
+STT_RETRY_AFTER = int(os.getenv("STT_RETRY_AFTER", 2))  # Seconds suggested to clients when the queue is full
+STT_AUTO_DOWNSHIFT_QUEUE = int(os.getenv("STT_AUTO_DOWNSHIFT_QUEUE", 0))  # Queue depth that triggers a smaller model (0 disables)
+STT_DOWNSHIFT_MODEL = os.getenv("STT_DOWNSHIFT_MODEL", "tiny")  # Model used while the queue is congested
+STT_UPSHIFT_AFTER_S = float(os.getenv("STT_UPSHIFT_AFTER_S", 60))  # Idle queue time before restoring the preferred model
+STT_BATCH_WINDOW_MS = float(os.getenv("STT_BATCH_WINDOW_MS", 10))  # How long to collect utterances for a batch
+STT_MAX_BATCH = int(os.getenv("STT_MAX_BATCH", 8))  # Maximum utterances decoded together
+STT_SAVE_AUDIO = os.getenv("STT_SAVE_AUDIO", "true").lower() == "true"  # Persist received audio to AUDIO_DIR
+UDP_SESSION_TIMEOUT = float(os.getenv("UDP_SESSION_TIMEOUT", 2.0))  # Seconds without packets before a recording is finalized
+UDP_MAX_RECORDING_S = float(os.getenv("UDP_MAX_RECORDING_S", 60))  # Ring buffer length per sender
+UDP_REORDER_WINDOW = int(os.getenv("UDP_REORDER_WINDOW", 32))  # Out-of-order packets held before a gap is declared lost
+STT_STREAM_STEP_MS = float(os.getenv("STT_STREAM_STEP_MS", 1000))  # New audio needed before the next partial hypothesis
+STT_STREAM_WINDOW_S = float(os.getenv("STT_STREAM_WINDOW_S", 20))  # Longest audio window used for partial hypotheses
+STT_STREAM_UDP = os.getenv("STT_STREAM_UDP", "true").lower() == "true"  # Emit partial results for UDP recordings
+STT_VAD = os.getenv("STT_VAD", "true").lower() == "true"  # Trim silence and split at pauses before Whisper
+VAD_FRAME_MS = int(os.getenv("VAD_FRAME_MS", 30))  # Analysis frame length
+VAD_ENERGY_DB = float(os.getenv("VAD_ENERGY_DB", -45))  # Frames quieter than this (dBFS) are never speech
+VAD_MARGIN_DB = float(os.getenv("VAD_MARGIN_DB", 12))  # Speech must exceed the noise floor by this much
+VAD_PADDING_MS = int(os.getenv("VAD_PADDING_MS", 200))  # Audio kept around detected speech
+VAD_MIN_PAUSE_MS = int(os.getenv("VAD_MIN_PAUSE_MS", 600))  # Pauses at least this long split a recording
+VAD_END_SILENCE_MS = int(os.getenv("VAD_END_SILENCE_MS", 1200))  # Trailing silence that ends a UDP utterance from a sender that never sends END
 
 # Create audio directory
 os.makedirs(AUDIO_DIR, exist_ok=True)
 
-# Initialize Whisper model
-logger.info(f"Loading Whisper model: {WHISPER_MODEL}")
-model = whisper.load_model(WHISPER_MODEL)
-logger.info("Whisper model loaded")
+def pcm16_to_float32(data):
+    """Convert 16-bit little-endian PCM bytes to the float32 array Whisper expects"""
+    return np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768.0
+
+def float32_to_pcm16(audio):
+    """Convert float32 samples back to 16-bit little-endian PCM bytes"""
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+
+def decode_audio_bytes(data):
+    """Decode an audio file held in memory to 16 kHz mono float32.
+
+    16 kHz mono 16-bit WAV (what the ESP32 path produces) is parsed directly;
+    anything else is piped through ffmpeg without touching the disk.
+    """
+    try:
+        with wave.open(io.BytesIO(data), 'rb') as wf:
+            if wf.getnchannels() == 1 and wf.getsampwidth() == 2 and wf.getframerate() == SAMPLE_RATE:
+                return pcm16_to_float32(wf.readframes(wf.getnframes()))
+    except (wave.Error, EOFError):
+        pass
+    return ffmpeg_decode(data)
+
+# Raw PCM request bodies: audio/pcm is little-endian (as the ESP32 sends it), audio/L16 big-endian (RFC 2586)
+RAW_PCM_FORMATS = {"audio/pcm": "s16le", "audio/l16": "s16be"}
+
+def decode_pcm_bytes(data, sample_format, rate, channels):
+    """Convert raw 16-bit PCM to 16 kHz mono float32, resampling through ffmpeg only when needed"""
+    if rate == SAMPLE_RATE and channels == 1:
+        dtype = "<i2" if sample_format == "s16le" else ">i2"
+        return np.frombuffer(data[:len(data) // 2 * 2], dtype=dtype).astype(np.float32) / 32768.0
+    return ffmpeg_decode(data, ["-f", sample_format, "-ar", str(rate), "-ac", str(channels)])
+
+def decode_request_audio(data, content_type):
+    """Decode a request body according to its Content-Type, e.g. 'audio/pcm; rate=8000' or 'audio/wav'"""
+    mime, _, params = content_type.partition(";")
+    options = {}
+    for param in params.split(";"):
+        key, _, value = param.partition("=")
+        options[key.strip().lower()] = value.strip()
+    
+    sample_format = RAW_PCM_FORMATS.get(mime.strip().lower())
+    if sample_format:
+        return decode_pcm_bytes(data, sample_format, int(options.get("rate") or SAMPLE_RATE),
+                                int(options.get("channels") or 1))
+    return decode_audio_bytes(data)
+
+def ffmpeg_decode(data, input_args=()):
+    """Decode audio bytes to 16 kHz mono float32 with ffmpeg, entirely over pipes"""
+    cmd = [
+        "ffmpeg", "-threads", "0", *input_args, "-i", "pipe:0",
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "-"
+    ]
+    try:
+        out = subprocess.run(cmd, input=data, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to decode audio: {e.stderr.decode(errors='ignore')}") from e
+    return pcm16_to_float32(out)
+
+def load_audio_file(path):
+    """Read an audio file and decode it in memory"""
+    with timed("decode"), open(path, "rb") as f:
+        return decode_audio_bytes(f.read())
+
+def write_wav(file_path, pcm):
+    """Write 16 kHz mono 16-bit PCM bytes as a WAV file"""
+    with wave.open(file_path, 'wb') as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)  # 16-bit
+        wf.setframerate(SAMPLE_RATE)
+        wf.writeframes(pcm)
+
+def write_bytes(file_path, data):
+    with open(file_path, "wb") as f:
+        f.write(data)
+
+def persist_in_background(writer, file_path, data):
+    """Write audio to disk off the event loop without delaying transcription"""
+    async def run():
+        try:
+            with timed("audio_write"):
+                await asyncio.to_thread(writer, file_path, data)
+            logger.info(f"Recording saved to: {file_path}")
+        except Exception as e:
+            logger.error(f"Error saving audio to {file_path}: {str(e)}")
+    return start_background_task(run())
+
+def new_audio_path(prefix, ext):
+    """Unique path for a new audio file in AUDIO_DIR.
+
+    Names are <prefix>_<uuid>.<ext>, so concurrent writers never collide, and
+    files are sharded into subdirectories by the first two hex digits. The TTS
+    service's cleanup task ages and budgets these files along with its own.
+    """
+    token = uuid.uuid4().hex
+    directory = os.path.join(AUDIO_DIR, token[:2])
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{prefix}_{token}.{ext}")
+
+# Voice activity detection: frame RMS energy against an adaptive noise floor,
+# with zero-crossing rate catching quiet fricatives, all computed per frame in NumPy
+VAD_FRAME_SAMPLES = SAMPLE_RATE * VAD_FRAME_MS // 1000
+VAD_MAX_SEGMENT_SAMPLES = 30 * SAMPLE_RATE  # One Whisper window
+
+def frame_features(audio):
+    """Return per-frame energy (dBFS) and zero-crossing rate"""
+    count = len(audio) // VAD_FRAME_SAMPLES
+    frames = audio[:count * VAD_FRAME_SAMPLES].reshape(count, VAD_FRAME_SAMPLES)
+    energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1e-10)
+    zcr = np.mean(np.signbit(frames[:, 1:]) != np.signbit(frames[:, :-1]), axis=1)
+    return energy_db, zcr
+
+def speech_frames(energy_db, zcr, noise_db, peak_db=None):
+    """Classify frames as speech given the noise floor (and, for whole recordings, the peak)"""
+    threshold = noise_db + VAD_MARGIN_DB
+    if peak_db is not None:
+        # Recordings that are speech throughout have no quiet frames to estimate noise from
+        threshold = min(threshold, peak_db - VAD_MARGIN_DB)
+    threshold = max(VAD_ENERGY_DB, threshold)
+    return (energy_db > threshold) | ((energy_db > threshold - 6) & (zcr > 0.3))
+
+def vad_segments(audio):
+    """Trim silence and split audio at pauses into speech segments of at most 30 s"""
+    energy_db, zcr = frame_features(audio)
+    if len(energy_db) == 0:
+        return []
+    speech = speech_frames(energy_db, zcr, np.percentile(energy_db, 10), energy_db.max())
+    if not speech.any():
+        return []
+    
+    # Close pauses shorter than VAD_MIN_PAUSE_MS, then pad what remains
+    gap = max(1, VAD_MIN_PAUSE_MS // VAD_FRAME_MS)
+    pad = VAD_PADDING_MS // VAD_FRAME_MS
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], speech.astype(np.int8), [0]))))
+    runs = edges.reshape(-1, 2)
+    merged = [list(runs[0])]
+    for start, end in runs[1:]:
+        if start - merged[-1][1] < gap:
+            merged[-1][1] = end
+        else:
+            merged.append([start, end])
+    
+    segments = []
+    for start, end in merged:
+        first = max(0, start - pad) * VAD_FRAME_SAMPLES
+        last = min(len(energy_db), end + pad) * VAD_FRAME_SAMPLES
+        segments.extend(split_long_segment(audio, first, last, energy_db))
+    return segments
+
+def split_long_segment(audio, first, last, energy_db):
+    """Cut a segment longer than one Whisper window at its quietest frame"""
+    if last - first <= VAD_MAX_SEGMENT_SAMPLES:
+        return [audio[first:last]]
+    # Search the middle half of the segment so both halves stay reasonably long
+    lo = (first + (last - first) // 4) // VAD_FRAME_SAMPLES
+    hi = (last - (last - first) // 4) // VAD_FRAME_SAMPLES
+    cut = (lo + int(np.argmin(energy_db[lo:hi]))) * VAD_FRAME_SAMPLES
+    return split_long_segment(audio, first, cut, energy_db) + split_long_segment(audio, cut, last, energy_db)
+
+class SilenceTracker:
+    """Incremental end-of-utterance detection for a live PCM stream"""
+
+    def __init__(self):
+        self.noise_db = None
+        self.speech_seen = False
+        self.trailing_frames = 0
+        self.remainder = np.empty(0, dtype=np.float32)
+
+    def feed(self, pcm):
+        audio = np.concatenate((self.remainder, pcm16_to_float32(pcm)))
+        energy_db, zcr = frame_features(audio)
+        self.remainder = audio[len(energy_db) * VAD_FRAME_SAMPLES:]
+        if len(energy_db) == 0:
+            return
+        
+        # Slowly rising minimum tracks the background level
+        floor = float(energy_db.min())
+        self.noise_db = floor if self.noise_db is None else min(self.noise_db + 0.1 * len(energy_db), floor)
+        
+        speech = np.flatnonzero(speech_frames(energy_db, zcr, self.noise_db))
+        if len(speech):
+            self.speech_seen = True
+            self.trailing_frames = len(energy_db) - 1 - int(speech[-1])
+        else:
+            self.trailing_frames += len(energy_db)
+
+    @property
+    def utterance_ended(self):
+        return self.speech_seen and self.trailing_frames * VAD_FRAME_MS >= VAD_END_SILENCE_MS
+
+class InferenceUnavailableError(Exception):
+    """Raised when inference cannot accept work right now (clients should retry)"""
+
+class QueueFullError(InferenceUnavailableError):
+    """Raised when the inference queue cannot accept more work"""
+
+class ModelNotReadyError(InferenceUnavailableError):
+    """Raised while no model has finished loading and warming up"""
+
+class InferenceExecutor:
+    """Run Whisper inference on a bounded pool of worker threads.
+
+    Each job borrows one of the model replicas for its duration: Whisper's
+    decoder installs kv-cache hooks on the model, so a single instance must
+    not be shared by concurrent decodes. Jobs beyond the worker count wait in
+    a queue of at most max_queue entries; further submissions are rejected.
+
+    Models are loaded and warmed up off the event loop. swap_model() builds a
+    complete new replica set before replacing the old one, so requests keep
+    being served by the previous model until the new one is ready.
+    """
+
+    def __init__(self, workers, max_queue):
+        self.model_name = None
+        self.workers = workers
+        self.max_queue = max_queue
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="whisper")
+        self.replicas = None
+        self.lock = threading.Lock()
+        self.swap_lock = asyncio.Lock()
+        self.loading = None  # Name of the model being loaded, if any
+        self.last_error = None
+        self.pending = 0  # Submitted jobs not yet finished
+        self.running = 0  # Jobs currently holding a replica
+        
+        # Split the CPU cores between the workers instead of letting each one use all of them
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
+
+    @property
+    def ready(self):
+        return self.replicas is not None
+
+    @property
+    def queue_depth(self):
+        return self.pending - self.running
+
+    def _load_replicas(self, model_name):
+        started = time.perf_counter()
+        replicas = [whisper.load_model(model_name) for _ in range(self.workers)]
+        logger.info(f"Loaded {self.workers} replicas of Whisper model {model_name} "
+                    f"in {time.perf_counter() - started:.1f} s")
+        return replicas
+
+    @staticmethod
+    def _warm_up(model):
+        # One short pass allocates buffers and primes kernels before real traffic
+        model.transcribe(np.zeros(SAMPLE_RATE, dtype=np.float32), fp16=False)
+
+    async def swap_model(self, model_name):
+        """Load, warm up and atomically switch to model_name"""
+        async with self.swap_lock:
+            if model_name == self.model_name:
+                return
+            self.loading = model_name
+            try:
+                replicas = await asyncio.to_thread(self._load_replicas, model_name)
+                started = time.perf_counter()
+                await asyncio.gather(*(asyncio.to_thread(self._warm_up, model) for model in replicas))
+                logger.info(f"Whisper model {model_name} warmed up in {time.perf_counter() - started:.1f} s")
+                
+                new_replicas = queue.SimpleQueue()
+                for model in replicas:
+                    new_replicas.put(model)
+                previous = self.model_name
+                self.replicas, self.model_name = new_replicas, model_name
+                self.last_error = None
+                logger.info(f"Whisper model switched: {previous} -> {model_name}")
+            except Exception as e:
+                self.last_error = f"Failed to load {model_name}: {str(e)}"
+                logger.error(self.last_error)
+                raise
+            finally:
+                self.loading = None
+
+    async def run(self, fn, *args):
+        """Run fn(model, *args) on a worker and return (result, timing)"""
+        replicas = self.replicas
+        if replicas is None:
+            STT_REJECTED.labels("not_ready").inc()
+            raise ModelNotReadyError("Whisper model is still loading")
+        with self.lock:
+            if self.pending >= self.workers + self.max_queue:
+                STT_REJECTED.labels("queue_full").inc()
+                raise QueueFullError(f"Inference queue is full ({self.queue_depth} waiting)")
+            self.pending += 1
+        
+        submitted = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.pool, self._execute, replicas, submitted, fn, args
+            )
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def _execute(self, replicas, submitted, fn, args):
+        # Replicas go back to the set they came from, so a swap never mixes models
+        model = replicas.get()
+        started = time.perf_counter()
+        with self.lock:
+            self.running += 1
+        try:
+            result = fn(model, *args)
+        finally:
+            with self.lock:
+                self.running -= 1
+            replicas.put(model)
+        finished = time.perf_counter()
+        STAGE_SECONDS.labels("stt_queue").observe(started - submitted)
+        STAGE_SECONDS.labels("stt_inference").observe(finished - started)
+        
+        return result, {
+            "queue_wait_ms": round((started - submitted) * 1000, 1),
+            "inference_ms": round((finished - started) * 1000, 1)
+        }
+
+    async def transcribe(self, audio):
+        """Transcribe a file path or float32 array and return (result, timing)"""
+        return await self.run(lambda model, audio: model.transcribe(audio, fp16=False), audio)
+
+    def stats(self):
+        return {
+            "model": self.model_name,
+            "ready": self.ready,
+            "loading": self.loading,
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "running": self.running,
+            "queue_depth": self.queue_depth
+        }
+
+def decode_batch(model, audios):
+    """Decode several single-window utterances with one encoder/decoder pass"""
+    mel = torch.stack([
+        whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), model.dims.n_mels)
+        for audio in audios
+    ]).to(model.device)
+    results = whisper.decode(model, mel, whisper.DecodingOptions(fp16=False))
+    return [{"text": result.text, "language": result.language} for result in results]
+
+class BatchScheduler:
+    """Micro-batch concurrent utterances in front of the inference executor.
+
+    Utterances arriving within window_ms of each other (up to max_batch) are
+    padded to one 30 s Whisper window, stacked and decoded together. Longer
+    recordings and lone utterances go through the regular transcribe path.
+    """
+
+    def __init__(self, executor, window_ms, max_batch):
+        self.executor = executor
+        self.window = window_ms / 1000
+        self.max_batch = max_batch
+        self.pending = []  # (audio, future)
+        self.flush_handle = None
+        self.batches = 0
+        self.batched_utterances = 0
+
+    async def transcribe(self, audio):
+        """Transcribe a file path or float32 array and return (result, timing)"""
+        if isinstance(audio, str):
+            audio = await asyncio.to_thread(load_audio_file, audio)
+        
+        if len(audio) > whisper.audio.N_SAMPLES or self.max_batch <= 1:
+            return await self.executor.transcribe(audio)
+        
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((audio, future))
+        if len(self.pending) >= self.max_batch:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            start_background_task(self._run(batch))
+
+    async def _run(self, batch):
+        audios = [audio for audio, _ in batch]
+        try:
+            if len(batch) == 1:
+                results, timing = await self.executor.transcribe(audios[0])
+                results = [results]
+            else:
+                results, timing = await self.executor.run(decode_batch, audios)
+                self.batches += 1
+                self.batched_utterances += len(batch)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        STT_BATCH_SIZE.observe(len(batch))
+        timing = {**timing, "batch_size": len(batch)}
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result((result, timing))
+
+    def stats(self):
+        return {
+            "batch_window_ms": self.window * 1000,
+            "max_batch": self.max_batch,
+            "collecting": len(self.pending),
+            "batches": self.batches,
+            "batched_utterances": self.batched_utterances
+        }
+
+# Whisper model replicas are loaded in the background at startup
+inference = InferenceExecutor(STT_WORKERS, STT_MAX_QUEUE)
+batcher = BatchScheduler(inference, STT_BATCH_WINDOW_MS, STT_MAX_BATCH)
+preferred_model = WHISPER_MODEL  # Model to run when not downshifted for load
+Gauge("voice_stt_queue_depth", "Transcriptions waiting for a worker").set_function(lambda: inference.queue_depth)
+Gauge("voice_stt_in_flight", "Transcriptions running on a worker").set_function(lambda: inference.running)
+
+async def load_model_in_background(model_name):
+    logger.info(f"Loading Whisper model: {model_name} ({STT_WORKERS} workers)")
+    try:
+        await inference.swap_model(model_name)
+    except Exception:
+        pass  # Already logged and reported through /ready and /admin/model
+
+async def auto_downshift_monitor():
+    """Switch to a smaller model while the queue is congested and back once it drains"""
+    idle_since = time.monotonic()
+    while True:
+        await asyncio.sleep(1)
+        if not inference.ready or inference.loading:
+            continue
+        depth = inference.queue_depth
+        if depth > 0:
+            idle_since = time.monotonic()
+        
+        try:
+            if depth > STT_AUTO_DOWNSHIFT_QUEUE and inference.model_name != STT_DOWNSHIFT_MODEL:
+                logger.warning(f"Queue depth {depth} exceeds {STT_AUTO_DOWNSHIFT_QUEUE}, switching to {STT_DOWNSHIFT_MODEL}")
+                await inference.swap_model(STT_DOWNSHIFT_MODEL)
+            elif (inference.model_name != preferred_model
+                  and time.monotonic() - idle_since >= STT_UPSHIFT_AFTER_S):
+                logger.info(f"Queue idle for {STT_UPSHIFT_AFTER_S} s, restoring {preferred_model}")
+                await inference.swap_model(preferred_model)
+        except Exception:
+            pass  # Already logged; try again on a later tick
+
+async def transcribe_utterance(audio):
+    """Transcribe a recording after trimming silence and splitting it at pauses.
+
+    Segments are submitted together so the batch scheduler can decode them in
+    one pass. Returns (result, timing) like BatchScheduler.transcribe.
+    """
+    if isinstance(audio, str):
+        audio = await asyncio.to_thread(load_audio_file, audio)
+    if not STT_VAD:
+        return await batcher.transcribe(audio)
+    
+    with timed("vad"):
+        segments = vad_segments(audio)
+    if not segments:
+        return {"text": ""}, {"queue_wait_ms": 0.0, "inference_ms": 0.0, "audio_s": round(len(audio) / SAMPLE_RATE, 2), "speech_s": 0.0}
+    
+    outputs = await asyncio.gather(*(batcher.transcribe(segment) for segment in segments))
+    text = " ".join(result["text"].strip() for result, _ in outputs if result["text"].strip())
+    return {"text": text}, {
+        "queue_wait_ms": max(timing["queue_wait_ms"] for _, timing in outputs),
+        "inference_ms": max(timing["inference_ms"] for _, timing in outputs),
+        "segments": len(segments),
+        "audio_s": round(len(audio) / SAMPLE_RATE, 2),
+        "speech_s": round(sum(len(segment) for segment in segments) / SAMPLE_RATE, 2)
+    }
+
+def unavailable_response(error):
+    """503 response telling the client to retry once inference is available again"""
+    return JSONResponse(
+        status_code=503,
+        content={"error": str(error)},
+        headers={"Retry-After": str(STT_RETRY_AFTER)}
+    )
 
 # Create FastAPI application
 app = FastAPI(title="Speech Recognition Service")
@@ -44,18 +594,98 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID"],
 )
 
+@app.middleware("http")
+async def correlation_id_middleware(request: Request, call_next):
+    """Tag the request with the caller's X-Request-ID, or a new one, and echo it back"""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
 class AudioRequest(BaseModel):
     audio_path: str
 
+class ModelRequest(BaseModel):
+    model: str
+
 @app.get("/")
 async def root():
     return {"message": "Speech Recognition Service is running"}
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/ready")
+async def readiness():
+    """Readiness probe: 200 once a model is loaded and warmed up"""
+    if not inference.ready:
+        return JSONResponse(
+            status_code=503,
+            content={"status": "loading", "model": inference.loading, "error": inference.last_error}
+        )
+    return {"status": "ready", "model": inference.model_name}
+
+@app.get("/admin/model")
+async def get_model():
+    """Get the active model and any load in progress"""
+    return {
+        "model": inference.model_name,
+        "preferred_model": preferred_model,
+        "loading": inference.loading,
+        "last_error": inference.last_error
+    }
+
+@app.post("/admin/model")
+async def set_model(request: ModelRequest):
+    """Load another model size in the background and switch to it when warmed up"""
+    global preferred_model
+    if request.model not in whisper.available_models():
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"Unknown Whisper model: {request.model}"}
+        )
+    
+    preferred_model = request.model
+    start_background_task(load_model_in_background(request.model))
+    return JSONResponse(status_code=202, content={"status": "loading", "model": request.model})
+
+@app.get("/queue")
+async def queue_status():
+    """Get inference worker and queue status"""
+    return {**inference.stats(), "batching": batcher.stats()}
+
+@app.get("/udp/sessions")
+async def udp_sessions():
+    """Get recordings currently being received over UDP"""
+    return {"sessions": [session.stats() for session in udp_receiver.sessions.values()]}
+
 @app.post("/transcribe")
-async def transcribe_audio(request: AudioRequest):
-    """Transcribe audio file at specified path"""
+async def transcribe_audio(http_request: Request):
+    """Transcribe the audio in the request body, or a file at a specified path.
+
+    A JSON body ({"audio_path": ...}) names a file on the shared audio volume.
+    Any other body is the recording itself: raw 16-bit PCM sent as audio/pcm
+    or audio/L16 (with optional rate and channels parameters), or an encoded
+    file such as WAV, MP3 or Ogg/Opus.
+    """
+    content_type = http_request.headers.get("content-type", "")
+    if not content_type.startswith("application/json"):
+        return await transcribe_body(await http_request.body(), content_type)
+    
+    try:
+        request = AudioRequest(**await http_request.json())
+    except ValueError as e:
+        return JSONResponse(
+            status_code=400,
+            content={"error": f"Invalid request: {str(e)}"}
+        )
+    
     try:
         audio_path = request.audio_path
         
@@ -67,11 +697,45 @@ async def transcribe_audio(request: AudioRequest):
         
         # Use Whisper for transcription
         logger.info(f"Starting transcription: {audio_path}")
-        result = model.transcribe(audio_path)
+        with timed("transcribe"):
+            result, timing = await transcribe_utterance(audio_path)
         transcription = result["text"]
-        logger.info(f"Transcription complete: {transcription}")
+        logger.info(f"Transcription complete ({timing['inference_ms']} ms): {transcription}")
+        
+        return {"text": transcription, "timing": timing}
+    
+    except InferenceUnavailableError as e:
+        return unavailable_response(e)
+    
+    except Exception as e:
+        logger.error(f"Transcription error: {str(e)}")
+        return JSONResponse(
+            status_code=500,
+            content={"error": f"Transcription error: {str(e)}"}
+        )
+
+async def transcribe_body(data, content_type):
+    """Transcribe audio bytes received inline, without a round trip through the disk"""
+    try:
+        with timed("transcribe"):
+            with timed("decode"):
+                audio = await asyncio.to_thread(decode_request_audio, data, content_type)
+            result, timing = await transcribe_utterance(audio)
+        transcription = result["text"]
+        logger.info(f"Transcription complete ({timing['inference_ms']} ms): {transcription}")
+        
+        response = {"text": transcription, "timing": timing}
+        
+        # Optionally keep a copy; nothing waits for it
+        if STT_SAVE_AUDIO and len(audio):
+            file_path = new_audio_path("request", "wav")
+            persist_in_background(write_wav, file_path, float32_to_pcm16(audio))
+            response["audio_path"] = file_path
         
-        return {"text": transcription}
+        return response
+    
+    except InferenceUnavailableError as e:
+        return unavailable_response(e)
     
     except Exception as e:
         logger.error(f"Transcription error: {str(e)}")
@@ -84,22 +748,30 @@ async def transcribe_audio(request: AudioRequest):
 async def upload_audio(file: UploadFile = File(...)):
     """Upload audio file and transcribe"""
     try:
-        # Save uploaded file
-        filename = f"upload_{int(time.time())}.wav"
-        file_path = os.path.join(AUDIO_DIR, filename)
+        data = await file.read()
         
-        with open(file_path, "wb") as buffer:
-            buffer.write(await file.read())
+        # Optionally keep a copy of the upload; transcription works from memory
+        file_path = None
+        if STT_SAVE_AUDIO:
+            file_path = new_audio_path("upload", "wav")
+            persist_in_background(write_bytes, file_path, data)
         
         # Use Whisper for transcription
-        result = model.transcribe(file_path)
+        with timed("transcribe"):
+            with timed("decode"):
+                audio = await asyncio.to_thread(decode_audio_bytes, data)
+            result, timing = await transcribe_utterance(audio)
         transcription = result["text"]
         
         return {
             "text": transcription,
-            "audio_path": file_path
+            "audio_path": file_path,
+            "timing": timing
         }
     
+    except InferenceUnavailableError as e:
+        return unavailable_response(e)
+    
     except Exception as e:
         logger.error(f"Error processing uploaded audio: {str(e)}")
         return JSONResponse(
@@ -107,75 +779,403 @@ async def upload_audio(file: UploadFile = File(...)):
             content={"error": f"Error processing uploaded audio: {str(e)}"}
         )
 
-# UDP server to handle ESP32 audio stream
-async def start_udp_server():
-    """Start UDP server to receive ESP32 audio data"""
-    logger.info(f"Starting UDP server on port: {UDP_PORT}")
+def common_word_prefix(a, b):
+    """Longest run of leading words shared by two hypotheses"""
+    words = []
+    for left, right in zip(a.split(), b.split()):
+        if left != right:
+            break
+        words.append(left)
+    return " ".join(words)
+
+class StreamingTranscriber:
+    """Incremental transcription of one live audio stream.
+
+    Every STT_STREAM_STEP_MS of new audio, Whisper is re-run on the current
+    window (at most STT_STREAM_WINDOW_S seconds) and a partial result is
+    emitted. Words that two consecutive hypotheses agree on are reported as
+    stable. When the window is full its text is committed and a new window
+    starts at the end of the audio already covered.
+
+    Partial passes only run while `active()` is true. A bounded transcriber
+    drops audio no later pass needs (and, while inactive, all but the last
+    window), so it can't be used for finish().
+    """
+
+    def __init__(self, emit, active=None, bounded=False):
+        self.emit = emit  # async callable receiving result dicts
+        self.active = active
+        self.bounded = bounded
+        self.pcm = bytearray()
+        self.trimmed = 0  # Bytes dropped from the front of pcm
+        self.window_start = 0  # Byte offset of the current window
+        self.covered = 0  # Byte offset up to which the last pass ran
+        self.committed = ""
+        self.previous = ""
+        self.step_bytes = int(STT_STREAM_STEP_MS / 1000 * SAMPLE_RATE) * 2
+        self.window_bytes = int(STT_STREAM_WINDOW_S * SAMPLE_RATE) * 2
+        self.task = None
+
+    def feed(self, pcm):
+        """Add PCM bytes and start a partial pass if enough new audio arrived"""
+        self.pcm.extend(pcm)
+        if self.task is not None:
+            return
+        active = self.active is None or self.active()
+        if self.bounded:
+            self._trim(active)
+        if active and len(self.pcm) - self.covered >= self.step_bytes:
+            self.task = asyncio.create_task(self._partial())
+
+    def _trim(self, active):
+        """Drop audio before the current window, or while inactive all but the last window"""
+        drop = self.window_start
+        if not active and len(self.pcm) - self.window_bytes > drop:
+            drop = len(self.pcm) - self.window_bytes
+            self.committed = self.previous = ""
+        # Trim a step at a time rather than shifting the buffer on every packet
+        if drop < self.step_bytes:
+            return
+        del self.pcm[:drop]
+        self.trimmed += drop
+        self.window_start = max(self.window_start - drop, 0)
+        self.covered = max(self.covered - drop, 0)
+
+    async def _partial(self):
+        try:
+            if len(self.pcm) - self.window_start > self.window_bytes:
+                # Window full: keep its text and slide past the audio already transcribed
+                self.committed = f"{self.committed} {self.previous}".strip()
+                self.previous = ""
+                self.window_start = self.covered
+            
+            end = len(self.pcm)
+            result, timing = await batcher.transcribe(pcm16_to_float32(bytes(self.pcm[self.window_start:end])))
+            self.covered = end
+            hypothesis = result["text"].strip()
+            stable = common_word_prefix(self.previous, hypothesis)
+            self.previous = hypothesis
+            
+            await self.emit({
+                "type": "partial",
+                "text": f"{self.committed} {hypothesis}".strip(),
+                "stable": f"{self.committed} {stable}".strip(),
+                "unstable": hypothesis[len(stable):].strip(),
+                "audio_s": round((self.trimmed + end) / 2 / SAMPLE_RATE, 2),
+                "timing": timing
+            })
+        except InferenceUnavailableError:
+            # Partial results are best effort; skip this step under load
+            pass
+        except Exception as e:
+            logger.error(f"Partial transcription error: {str(e)}")
+        finally:
+            self.task = None
+
+    def cancel(self):
+        if self.task:
+            self.task.cancel()
+
+    async def finish(self):
+        """Transcribe the whole utterance and return the final result"""
+        self.cancel()
+        audio = pcm16_to_float32(bytes(self.pcm))
+        result, timing = await transcribe_utterance(audio)
+        self.pcm = bytearray()
+        self.window_start = self.covered = self.trimmed = 0
+        self.committed = self.previous = ""
+        return {"type": "final", "text": result["text"], "timing": timing}
+
+# Clients subscribed to transcripts of UDP recordings
+transcript_subscribers = {}
+
+async def broadcast_transcript(message):
+    """Send a transcript event to all subscribed WebSocket clients"""
+    for client_id, websocket in list(transcript_subscribers.items()):
+        try:
+            await websocket.send_json(message)
+        except Exception as e:
+            logger.error(f"WebSocket send failed: {str(e)}")
+
+def is_end_message(text):
+    """True for a plain "END" text frame or a {"type": "end"} JSON frame"""
+    if not text:
+        return False
+    if text.strip().upper() == "END":
+        return True
+    try:
+        return json.loads(text).get("type") == "end"
+    except (ValueError, AttributeError):
+        return False
+
+@app.websocket("/ws/stream")
+async def stream_transcription(websocket: WebSocket):
+    """Live transcription: send binary 16 kHz int16 PCM frames, then "END" to finish an utterance"""
+    await websocket.accept()
+    transcriber = StreamingTranscriber(websocket.send_json)
     
-    # Create UDP socket
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.bind(('0.0.0.0', UDP_PORT))
-    sock.setblocking(False)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            if message.get("bytes"):
+                transcriber.feed(message["bytes"])
+            elif is_end_message(message.get("text")):
+                try:
+                    await websocket.send_json(await transcriber.finish())
+                except InferenceUnavailableError as e:
+                    await websocket.send_json({"type": "error", "error": str(e), "retry_after": STT_RETRY_AFTER})
     
-    # Frame counter
-    frame_count = 0
-    buffer = bytearray()
-    current_file = None
+    except WebSocketDisconnect:
+        pass
     
-    while True:
+    except Exception as e:
+        logger.error(f"WebSocket error: {str(e)}")
+    
+    finally:
+        transcriber.cancel()
+
+@app.websocket("/ws/transcripts")
+async def transcript_feed(websocket: WebSocket):
+    """Subscribe to partial and final transcripts of UDP recordings"""
+    await websocket.accept()
+    client_id = id(websocket)
+    transcript_subscribers[client_id] = websocket
+    
+    try:
+        while True:
+            await websocket.receive_text()
+    
+    except WebSocketDisconnect:
+        pass
+    
+    finally:
+        transcript_subscribers.pop(client_id, None)
+
+# UDP server to handle ESP32 audio stream.
+# Packets are b'START', b'END', or PCM audio. Audio packets may carry a sequence
+# header (b'SEQ' + big-endian uint32) for reordering and loss accounting;
+# packets without it are appended in arrival order.
+SEQ_HEADER = b'SEQ'
+SEQ_HEADER_SIZE = len(SEQ_HEADER) + 4
+
+class UdpSession:
+    """One recording in progress from a single sender address"""
+
+    def __init__(self, addr, capacity):
+        self.addr = addr
+        self.buffer = bytearray(capacity)  # Preallocated ring buffer
+        self.write_pos = 0
+        self.wrapped = False
+        self.next_seq = None
+        self.pending = {}  # seq -> payload, held until the gap before it is filled
+        self.payload_size = 0
+        self.packets = 0
+        self.lost = 0
+        self.late = 0
+        self.reordered = 0
+        self.started = time.monotonic()
+        self.last_packet = self.started
+        self.silence = SilenceTracker() if STT_VAD else None
+        self.transcriber = None
+        if STT_STREAM_UDP:
+            session = f"{addr[0]}:{addr[1]}"
+            # Partials are only worth inference time while someone is listening
+            self.transcriber = StreamingTranscriber(
+                lambda result: broadcast_transcript({**result, "session": session}),
+                active=lambda: bool(transcript_subscribers),
+                bounded=True
+            )
+
+    def write(self, payload):
+        """Append payload to the ring buffer, overwriting the oldest audio when full"""
+        if self.transcriber:
+            self.transcriber.feed(payload)
+        if self.silence:
+            self.silence.feed(payload)
+        view = memoryview(payload)
+        capacity = len(self.buffer)
+        while len(view) > 0:
+            count = min(len(view), capacity - self.write_pos)
+            self.buffer[self.write_pos:self.write_pos + count] = view[:count]
+            view = view[count:]
+            self.write_pos += count
+            if self.write_pos == capacity:
+                self.write_pos = 0
+                self.wrapped = True
+
+    def receive(self, data):
+        """Handle one audio datagram"""
+        self.last_packet = time.monotonic()
+        self.packets += 1
+        
+        if not data.startswith(SEQ_HEADER) or len(data) < SEQ_HEADER_SIZE:
+            self.write(data)
+            return
+        
+        seq = struct.unpack_from(">I", data, len(SEQ_HEADER))[0]
+        payload = data[SEQ_HEADER_SIZE:]
+        self.payload_size = len(payload)
+        
+        if self.next_seq is None:
+            self.next_seq = seq
+        if seq < self.next_seq or seq in self.pending:
+            self.late += 1
+            return
+        if seq > self.next_seq:
+            self.reordered += 1
+            self.pending[seq] = payload
+            if len(self.pending) > UDP_REORDER_WINDOW:
+                self.skip_gap()
+            return
+        
+        self.write(payload)
+        self.next_seq += 1
+        self.drain()
+
+    def drain(self):
+        while self.next_seq in self.pending:
+            self.write(self.pending.pop(self.next_seq))
+            self.next_seq += 1
+
+    def skip_gap(self):
+        """Give up on missing packets before the oldest held one and fill them with silence"""
+        target = min(self.pending)
+        missing = target - self.next_seq
+        self.lost += missing
+        # A corrupt or restarted sequence number can jump by billions; more
+        # silence than the ring buffer holds would only overwrite itself
+        self.write(bytes(min(missing * self.payload_size, len(self.buffer))))
+        self.next_seq = target
+        self.drain()
+
+    def finish(self):
+        """Flush held packets and return the recording as contiguous PCM bytes"""
+        while self.pending:
+            self.skip_gap()
+        if self.wrapped:
+            return bytes(self.buffer[self.write_pos:]) + bytes(self.buffer[:self.write_pos])
+        return bytes(self.buffer[:self.write_pos])
+
+    def stats(self):
+        return {
+            "addr": f"{self.addr[0]}:{self.addr[1]}",
+            "packets": self.packets,
+            "lost": self.lost,
+            "late": self.late,
+            "reordered": self.reordered,
+            "bytes": len(self.buffer) if self.wrapped else self.write_pos,
+            "overflowed": self.wrapped,
+            "duration_s": round(time.monotonic() - self.started, 2)
+        }
+
+class AudioReceiverProtocol(asyncio.DatagramProtocol):
+    """Receive ESP32 audio datagrams, keeping one session per sender address"""
+
+    def __init__(self):
+        self.sessions = {}
+        self.capacity = int(UDP_MAX_RECORDING_S * SAMPLE_RATE) * 2
+        self.end_senders = set()  # Hosts known to send END, whose pauses must not split an utterance
+
+    def datagram_received(self, data, addr):
         try:
-            # Receive data
-            data, addr = await asyncio.get_event_loop().sock_recv(sock, 1024)
-            
             if data.startswith(b'START'):
-                # New recording starts
-                frame_count = 0
-                buffer = bytearray()
+                # New recording starts; finish any recording the sender left open
+                if addr in self.sessions:
+                    self.finalize(addr, "restarted")
+                self.sessions[addr] = UdpSession(addr, self.capacity)
                 logger.info(f"Receiving new recording from: {addr}")
-                continue
-                
-            elif data.startswith(b'END'):
-                # Recording ends, save file
-                if len(buffer) > 0:
-                    file_name = f"esp32_{int(time.time())}.wav"
-                    file_path = os.path.join(AUDIO_DIR, file_name)
-                    
-                    # Save as WAV file
-                    with wave.open(file_path, 'wb') as wf:
-                        wf.setnchannels(1)
-                        wf.setsampwidth(2)  # 16-bit
-                        wf.setframerate(SAMPLE_RATE)
-                        wf.writeframes(buffer)
-                    
-                    logger.info(f"Recording saved to: {file_path}")
-                    current_file = file_path
-                    
-                    # Process transcription asynchronously
-                    asyncio.create_task(process_new_audio(file_path))
-                
-                buffer = bytearray()
-                frame_count = 0
-                continue
             
-            # Accumulate audio data
-            buffer.extend(data)
-            frame_count += 1
+            elif data.startswith(b'END'):
+                self.end_senders.add(addr[0])
+                self.finalize(addr, "end")
             
-        except BlockingIOError:
-            await asyncio.sleep(0.01)
+            else:
+                session = self.sessions.get(addr)
+                if session is None:
+                    session = self.sessions[addr] = UdpSession(addr, self.capacity)
+                session.receive(data)
+                
+                # Senders that never send END have their utterance ended by trailing silence
+                if session.silence and session.silence.utterance_ended and addr[0] not in self.end_senders:
+                    self.finalize(addr, "silence")
         
         except Exception as e:
             logger.error(f"UDP processing error: {str(e)}")
-            await asyncio.sleep(1)
 
-async def process_new_audio(file_path):
-    """Process newly received audio file"""
+    def finalize(self, addr, reason):
+        """Close a sender's session and hand its audio to transcription"""
+        session = self.sessions.pop(addr, None)
+        if session is None:
+            return
+        pcm = session.finish()
+        if session.transcriber:
+            session.transcriber.cancel()
+        stats = session.stats()
+        logger.info(f"Recording from {addr} finished ({reason}): {stats}")
+        STAGE_SECONDS.labels("udp_receive").observe(stats["duration_s"])
+        UDP_RECORDINGS.labels(reason).inc()
+        for outcome in ("packets", "lost", "late", "reordered"):
+            UDP_PACKETS.labels(outcome).inc(stats[outcome])
+        if not pcm:
+            return
+        if session.silence and not session.silence.speech_seen:
+            logger.info(f"Recording from {addr} has no speech, not transcribing")
+            return
+        
+        # Optionally save as WAV file
+        if STT_SAVE_AUDIO:
+            persist_in_background(write_wav, new_audio_path("esp32", "wav"), pcm)
+        
+        # Process transcription asynchronously, straight from memory
+        start_background_task(process_new_audio(pcm16_to_float32(pcm), f"{addr[0]}:{addr[1]}"))
+
+    def expire_sessions(self):
+        """Finalize sessions whose sender stopped without sending END"""
+        now = time.monotonic()
+        for addr, session in list(self.sessions.items()):
+            if now - session.last_packet > UDP_SESSION_TIMEOUT:
+                self.finalize(addr, "timeout")
+
+    def error_received(self, exc):
+        logger.error(f"UDP socket error: {str(exc)}")
+
+udp_receiver = AudioReceiverProtocol()
+Gauge("voice_udp_sessions", "UDP recordings in progress").set_function(lambda: len(udp_receiver.sessions))
+
+async def start_udp_server():
+    """Start UDP server to receive ESP32 audio data"""
+    logger.info(f"Starting UDP server on port: {UDP_PORT}")
+    
+    transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+        lambda: udp_receiver, local_addr=('0.0.0.0', UDP_PORT)
+    )
+    # Larger kernel buffer so bursts from several microphones are not dropped
+    transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 20)
+    
+    while True:
+        await asyncio.sleep(UDP_SESSION_TIMEOUT / 4)
+        udp_receiver.expire_sessions()
+
+async def process_new_audio(audio, session=None):
+    """Process newly received audio (float32 samples or a file path)"""
+    # UDP recordings start a turn here; the ID travels with the transcript
+    request_id = uuid.uuid4().hex
+    request_id_var.set(request_id)
     try:
         # Use Whisper for transcription
-        result = model.transcribe(file_path)
+        with timed("transcribe"):
+            result, timing = await transcribe_utterance(audio)
         transcription = result["text"]
         
-        logger.info(f"Transcription result: {transcription}")
+        logger.info(f"Transcription result ({timing['queue_wait_ms']} ms queued, "
+                    f"{timing['inference_ms']} ms inference): {transcription}")
+        if not transcription.strip():
+            return
+        
+        await broadcast_transcript({"type": "final", "text": transcription, "timing": timing,
+                                    "session": session, "request_id": request_id})
         
         # Here you can send to coordinator service or other processing
         # TODO: Implement communication with coordinator service
@@ -186,8 +1186,13 @@ async def process_new_audio(file_path):
 @app.on_event("startup")
 async def startup_event():
     """Event handler for application startup"""
+    # Load and warm up the model without blocking startup
+    start_background_task(load_model_in_background(WHISPER_MODEL))
+    if STT_AUTO_DOWNSHIFT_QUEUE > 0:
+        start_background_task(auto_downshift_monitor())
+    
     # Start UDP server
-    asyncio.create_task(start_udp_server())
+    start_background_task(start_udp_server())
 
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8000, reload=False)
\ No newline at end of file
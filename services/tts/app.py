@@ -1,26 +1,81 @@
 import os
+import re
 import logging
 import time
 import asyncio
+import hashlib
+import math
+import uuid
+import contextvars
+from collections import OrderedDict
+from contextlib import aclosing, contextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from stat import S_ISREG
 from pathlib import Path
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
+import numpy as np
 import uvicorn
 from pydantic import BaseModel
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
 import edge_tts  # Using Microsoft Edge TTS as the TTS engine
 
+# Correlation ID of the request being handled (X-Request-ID), added to log lines
+request_id_var = contextvars.ContextVar("request_id", default="-")
+_record_factory = logging.getLogRecordFactory()
+
+def record_with_request_id(*args, **kwargs):
+    record = _record_factory(*args, **kwargs)
+    record.request_id = request_id_var.get()
+    return record
+
+logging.setLogRecordFactory(record_with_request_id)
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    format='%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s'
 )
 logger = logging.getLogger(__name__)
 
+# Prometheus metrics, served at /metrics
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+STAGE_SECONDS = Histogram("voice_stage_duration_seconds", "Time spent in each stage of a voice turn",
+                          ["stage"], buckets=STAGE_BUCKETS)
+CACHE_LOOKUPS = Counter("voice_tts_cache_lookups_total", "Synthesis cache lookups by result", ["result"])
+CACHE_EVICTIONS = Counter("voice_tts_cache_evictions_total", "Cached audio files evicted")
+AUDIO_FILES_REMOVED = Counter("voice_audio_files_removed_total", "Audio files deleted by the cleanup task", ["reason"])
+
+@contextmanager
+def timed(stage):
+    """Record how long the block takes under the given stage"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+# Fire-and-forget tasks; the event loop only keeps weak references to tasks,
+# so they are held here until they finish
+background_tasks = set()
+
+def start_background_task(coro):
+    """Run a coroutine as a task that nobody awaits, keeping it referenced until done"""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 # Environment variables
 AUDIO_DIR = os.getenv("AUDIO_DIR", "/app/audio")
 TTS_VOICE = os.getenv("TTS_VOICE", "en-US-AriaNeural")  # English female voice
-OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "mp3")  # Output format, ESP32 typically uses MP3
+OUTPUT_FORMAT = os.getenv("OUTPUT_FORMAT", "mp3")  # Default output format: mp3, wav, opus, pcm16k, pcm8k or ulaw
+TTS_OPUS_BITRATE = os.getenv("TTS_OPUS_BITRATE", "24k")  # Opus bitrate; speech stays intelligible down to ~12k
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", 256 * 1024 * 1024))  # Byte budget for cached audio
+AUDIO_MAX_AGE_S = float(os.getenv("AUDIO_MAX_AGE_S", 24 * 3600))  # Audio unused for longer than this is deleted (0 disables)
+AUDIO_MAX_BYTES = int(os.getenv("AUDIO_MAX_BYTES", 1024 * 1024 * 1024))  # Byte budget for all audio in AUDIO_DIR, STT files and cache included (0 disables)
+AUDIO_CLEANUP_INTERVAL_S = float(os.getenv("AUDIO_CLEANUP_INTERVAL_S", 300))  # Time between cleanup sweeps
 
 # Create audio directory
 os.makedirs(AUDIO_DIR, exist_ok=True)
@@ -35,17 +90,582 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "X-Audio-Path", "X-Audio-Format", "X-Cache", "ETag", "Content-Range"],
 )
 
+@app.middleware("http")
+async def correlation_id_middleware(request: Request, call_next):
+    """Tag the request with the caller's X-Request-ID, or a new one, and echo it back"""
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+# Media types for the audio formats we serve
+MEDIA_TYPES = {
+    "mp3": "audio/mpeg",
+    "wav": "audio/wav",
+    "opus": "audio/ogg",
+    "pcm16k": "audio/pcm;rate=16000",
+    "pcm8k": "audio/pcm;rate=8000",
+    "ulaw": "audio/basic",
+}
+
+# Edge TTS always produces 24 kHz mono MP3. Other formats are decoded by an
+# ffmpeg process as the MP3 arrives: container formats are encoded by ffmpeg
+# too, while raw formats for the ESP32 get 24 kHz PCM that NumPy resamples and
+# encodes chunk by chunk.
+DECODE_RATE = 24000
+RAW_FORMATS = {  # format -> (sample rate, encoding)
+    "pcm16k": (16000, "pcm"),
+    "pcm8k": (8000, "pcm"),
+    "ulaw": (8000, "ulaw"),
+}
+FFMPEG_OUTPUT_ARGS = {
+    "wav": ["-ac", "1", "-ar", "16000", "-f", "wav"],
+    "opus": ["-ac", "1", "-c:a", "libopus", "-b:a", TTS_OPUS_BITRATE, "-application", "voip", "-f", "ogg"],
+    **{fmt: ["-ac", "1", "-ar", str(DECODE_RATE), "-f", "s16le"] for fmt in RAW_FORMATS},
+}
+FFMPEG_READ_SIZE = 16 * 1024
+
+def unsupported_format_response(fmt):
+    return JSONResponse(
+        status_code=400,
+        content={"error": f"Unsupported format: {fmt} (expected one of {', '.join(MEDIA_TYPES)})"}
+    )
+
+def build_ulaw_table():
+    """G.711 μ-law code for every int16 sample, indexed by its 16-bit pattern (as in the Sun reference coder)"""
+    pcm = np.arange(-32768, 32768, dtype=np.int32)
+    value = pcm >> 2  # G.711 works on 14-bit samples
+    mask = np.where(value < 0, 0x7F, 0xFF)
+    magnitude = np.minimum(np.minimum(np.abs(value), 8159) + 0x21, 0x1FFF)
+    segment = np.floor(np.log2(magnitude)).astype(np.int32) - 5
+    mantissa = (magnitude >> (segment + 1)) & 0x0F
+    table = np.empty(65536, dtype=np.uint8)
+    table[pcm.astype(np.uint16)] = ((segment << 4) | mantissa) ^ mask
+    return table
+
+ULAW_TABLE = build_ulaw_table()
+
+class StreamingResampler:
+    """Rational-ratio polyphase resampler fed one chunk at a time.
+
+    A Kaiser-windowed sinc low-pass, cut off just below the lower of the two
+    Nyquist rates, is split into `up` phases. Each output sample is the dot
+    product of one phase with the most recent input samples, computed for a
+    whole chunk at once. Only the last few input samples are carried between
+    chunks, the filter delay is skipped so output lines up with the input,
+    and flush() returns the tail.
+    """
+
+    ZERO_CROSSINGS = 16  # Filter half-length, in periods of the lower Nyquist rate
+
+    def __init__(self, src_rate, dst_rate):
+        divisor = math.gcd(src_rate, dst_rate)
+        self.up, self.down = dst_rate // divisor, src_rate // divisor
+        self.width = math.ceil(2 * self.ZERO_CROSSINGS * max(self.up, self.down) / self.up)
+        taps = self.width * self.up
+        cutoff = 0.45 / max(self.up, self.down)  # cycles per sample at the upsampled rate
+        # Centred on a whole sample so that skipping the delay aligns output exactly
+        self.delay = (taps - 1) // 2
+        window = np.zeros(taps)
+        window[:2 * self.delay + 1] = np.kaiser(2 * self.delay + 1, 7.0)
+        kernel = 2 * cutoff * self.up * np.sinc(2 * cutoff * (np.arange(taps) - self.delay)) * window
+        # phases[p, j] = kernel[p + j * up]; taps are applied newest sample first
+        self.phases = kernel.reshape(self.width, self.up).T.astype(np.float32)
+        self.history = np.zeros(self.width - 1, dtype=np.float32)
+        self.consumed = 0
+        self.produced = 0
+
+    def process(self, samples):
+        buffer = np.concatenate([self.history, samples.astype(np.float32)])
+        start = self.consumed - len(self.history)  # input index of buffer[0]
+        self.consumed += len(samples)
+        
+        # Every output whose newest input sample has arrived
+        end = (self.consumed * self.up - 1 - self.delay) // self.down + 1
+        positions = np.arange(self.produced, max(end, self.produced)) * self.down + self.delay
+        newest = positions // self.up - start
+        window = buffer[newest[:, None] - np.arange(self.width)]
+        output = np.einsum("ij,ij->i", window, self.phases[positions % self.up])
+        
+        self.produced += len(output)
+        self.history = buffer[len(buffer) - (self.width - 1):]
+        return output
+
+    def flush(self):
+        remaining = -(-self.consumed * self.up // self.down) - self.produced
+        if remaining <= 0:
+            return np.zeros(0, dtype=np.float32)
+        return self.process(np.zeros(self.delay // self.up + self.width, dtype=np.float32))[:remaining]
+
+class RawEncoder:
+    """Streaming NumPy stage turning decoded 24 kHz int16 PCM into a raw output format"""
+
+    def __init__(self, fmt):
+        rate, self.encoding = RAW_FORMATS[fmt]
+        self.resampler = StreamingResampler(DECODE_RATE, rate)
+        self.pending = b""  # Odd byte left over from the previous chunk
+
+    def encode(self, data):
+        data = self.pending + data
+        usable = len(data) - len(data) % 2
+        self.pending = data[usable:]
+        return self._encode(self.resampler.process(np.frombuffer(data[:usable], dtype="<i2")))
+
+    def flush(self):
+        return self._encode(self.resampler.flush())
+
+    def _encode(self, audio):
+        pcm = np.clip(np.round(audio), -32768, 32767).astype("<i2")
+        if self.encoding == "ulaw":
+            return ULAW_TABLE[pcm.view(np.uint16)].tobytes()
+        return pcm.tobytes()
+
+async def ffmpeg_pipe(chunks, output_args):
+    """Stream MP3 chunks through ffmpeg, yielding its output as soon as it is written"""
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-fflags", "nobuffer", "-probesize", "32", "-analyzeduration", "0",
+        "-f", "mp3", "-i", "pipe:0", *output_args, "-flush_packets", "1", "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    
+    async def feed():
+        try:
+            async for data in chunks:
+                process.stdin.write(data)
+                await process.stdin.drain()
+        finally:
+            process.stdin.close()
+    
+    feeder = asyncio.create_task(feed())
+    try:
+        while True:
+            data = await process.stdout.read(FFMPEG_READ_SIZE)
+            if not data:
+                break
+            yield data
+        # Surface synthesis errors from the feeder, then ffmpeg's own
+        await feeder
+        if await process.wait() != 0:
+            error = (await process.stderr.read()).decode(errors="replace").strip()
+            raise RuntimeError(f"ffmpeg exited with {process.returncode}: {error}")
+    finally:
+        feeder.cancel()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+async def transcode_chunks(chunks, fmt):
+    """Convert Edge TTS MP3 chunks to fmt, one chunk at a time"""
+    if fmt == "mp3":
+        async for data in chunks:
+            yield data
+        return
+    
+    encoder = RawEncoder(fmt) if fmt in RAW_FORMATS else None
+    async with aclosing(ffmpeg_pipe(chunks, FFMPEG_OUTPUT_ARGS[fmt])) as output:
+        async for data in output:
+            if encoder:
+                data = encoder.encode(data)
+            if data:
+                yield data
+    if encoder:
+        tail = encoder.flush()
+        if tail:
+            yield tail
+
+def new_audio_path(prefix, ext):
+    """Unique path for a new audio file in AUDIO_DIR.
+
+    Names are <prefix>_<uuid>.<ext>, so concurrent writers never collide, and
+    files are sharded into subdirectories by the first two hex digits. The STT
+    service names its files the same way.
+    """
+    token = uuid.uuid4().hex
+    directory = os.path.join(AUDIO_DIR, token[:2])
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, f"{prefix}_{token}.{ext}")
+
+class AudioJanitor:
+    """Keeps the audio in AUDIO_DIR under an age limit and a single byte budget.
+
+    The volume is shared with the STT service and this is the only cleanup task
+    on it, so it covers both services' files; only names starting with one of
+    `prefixes` are considered. Each sweep walks the top level and the shard
+    directories, deletes files older than max_age_s, then the oldest remaining
+    files until the rest fit in max_bytes. on_remove is called before a file is
+    deleted so that anything indexing it can forget it.
+    """
+
+    def __init__(self, directory, prefixes, max_age_s, max_bytes, interval_s, on_remove=None):
+        self.directory = directory
+        self.prefixes = tuple(prefixes)
+        self.max_age_s = max_age_s
+        self.max_bytes = max_bytes
+        self.interval_s = interval_s
+        self.on_remove = on_remove
+        self.files = 0
+        self.bytes = 0
+        self.by_prefix = {}
+        self.removed = {"age": 0, "budget": 0}
+        self.removed_bytes = 0
+        self.last_sweep = None
+        self.last_sweep_ms = 0.0
+
+    def scan(self):
+        """Return (mtime, path, size) for every file with one of the prefixes"""
+        found = []
+        directories = [self.directory]
+        for directory in directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if directory == self.directory:
+                                directories.append(entry.path)
+                        elif entry.name.startswith(self.prefixes):
+                            try:
+                                stat = entry.stat()
+                            except FileNotFoundError:
+                                continue
+                            found.append((stat.st_mtime, entry.path, stat.st_size))
+            except FileNotFoundError:
+                continue
+        return found
+
+    def remove(self, path, reason, size, cutoff=None):
+        """Delete one file; returns False if it was kept after all"""
+        try:
+            # A file touched since the scan is no longer expired
+            if cutoff is not None and os.stat(path).st_mtime >= cutoff:
+                return False
+            if self.on_remove:
+                self.on_remove(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return True
+        except OSError as e:
+            logger.error(f"Error deleting {path}: {str(e)}")
+            return False
+        self.removed[reason] += 1
+        self.removed_bytes += size
+        AUDIO_FILES_REMOVED.labels(reason).inc()
+        return True
+
+    async def sweep(self):
+        started = time.perf_counter()
+        files = sorted(await asyncio.to_thread(self.scan))
+        cutoff = time.time() - self.max_age_s if self.max_age_s > 0 else None
+        total = sum(size for _, _, size in files)
+        
+        kept = []
+        removed = 0
+        for mtime, path, size in files:
+            reason = None
+            if cutoff is not None and mtime < cutoff:
+                reason = "age"
+            elif self.max_bytes > 0 and total > self.max_bytes and not path.endswith(".part"):
+                # Oldest first; partial files are still being written
+                reason = "budget"
+            if reason and self.remove(path, reason, size, cutoff if reason == "age" else None):
+                total -= size
+                removed += 1
+                if removed % 100 == 0:
+                    await asyncio.sleep(0)
+            else:
+                kept.append((path, size))
+        
+        by_prefix = {}
+        for path, size in kept:
+            prefix = os.path.basename(path).split("_", 1)[0]
+            counts = by_prefix.setdefault(prefix, {"files": 0, "bytes": 0})
+            counts["files"] += 1
+            counts["bytes"] += size
+        self.files = len(kept)
+        self.bytes = total
+        self.by_prefix = by_prefix
+        self.last_sweep = time.time()
+        self.last_sweep_ms = round((time.perf_counter() - started) * 1000, 1)
+        if removed:
+            logger.info(f"Audio cleanup removed {removed} files, {self.files} files ({self.bytes} bytes) remain")
+
+    async def run(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Audio cleanup error: {str(e)}")
+            await asyncio.sleep(self.interval_s)
+
+    def stats(self):
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "by_prefix": self.by_prefix,
+            "max_age_s": self.max_age_s,
+            "max_bytes": self.max_bytes,
+            "removed_files": dict(self.removed),
+            "removed_bytes": self.removed_bytes,
+            "last_sweep": self.last_sweep,
+            "last_sweep_ms": self.last_sweep_ms
+        }
+
 class TTSRequest(BaseModel):
     text: str
     voice: str = TTS_VOICE
     format: str = OUTPUT_FORMAT
+    inline: bool = False  # Return the audio itself instead of its path on the shared volume
+
+class StreamRequest(TTSRequest):
+    save: bool = False  # Also write the streamed audio to AUDIO_DIR
+
+class SynthesisCache:
+    """Content-addressed cache of synthesized audio files in AUDIO_DIR.
+
+    Files are named tts_<sha256(voice, format, text)>.<format> and sharded by
+    the first two hex digits, so the index can be rebuilt from disk on startup.
+    Entries are kept in LRU order and evicted (file included) once the byte
+    budget is exceeded. A hit touches the file's mtime, which keeps the LRU
+    order across restarts and lets the cleanup task age files by last use.
+    Concurrent requests for the same key share a single synthesis.
+    """
+
+    FILE_PATTERN = re.compile(r"^tts_([0-9a-f]{64})\.(\w+)$")
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (path, size)
+        self.total_bytes = 0
+        self.in_flight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(text, voice, fmt):
+        return hashlib.sha256(f"{voice}\0{fmt}\0{text}".encode("utf-8")).hexdigest()
+
+    def path_for(self, key, fmt):
+        directory = os.path.join(self.directory, key[:2])
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"tts_{key}.{fmt}")
+
+    def load(self):
+        """Index cached files already on disk (sharded or from before sharding), oldest first"""
+        found = []
+        shards = [entry.path for entry in os.scandir(self.directory) if entry.is_dir()]
+        for directory in [self.directory, *shards]:
+            for entry in os.scandir(directory):
+                match = self.FILE_PATTERN.match(entry.name)
+                if match and entry.is_file():
+                    stat = entry.stat()
+                    found.append((stat.st_mtime, match.group(1), entry.path, stat.st_size))
+        for _, key, path, size in sorted(found):
+            self._add(key, path, size)
+        self._evict()
+        logger.info(f"Synthesis cache loaded: {len(self.entries)} files, {self.total_bytes} bytes")
+
+    def lookup(self, key):
+        """Return the cached path for a key, or None"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        try:
+            os.utime(entry[0])
+        except FileNotFoundError:
+            self.discard(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry:
+            self.total_bytes -= entry[1]
+
+    def forget(self, path):
+        """Drop the entry for a file about to be deleted outside the cache"""
+        match = self.FILE_PATTERN.match(os.path.basename(path))
+        if match and self.entries.get(match.group(1), (None,))[0] == path:
+            self.discard(match.group(1))
+
+    async def get_or_synthesize(self, text, voice, fmt):
+        """Return (path, status), where status is one of hit, miss or coalesced"""
+        key = self.make_key(text, voice, fmt)
+        path = self.lookup(key)
+        if path:
+            self.hits += 1
+            CACHE_LOOKUPS.labels("hit").inc()
+            return path, "hit"
+        
+        task = self.in_flight.get(key)
+        if task:
+            self.coalesced += 1
+            CACHE_LOOKUPS.labels("coalesced").inc()
+            return await asyncio.shield(task), "coalesced"
+        
+        self.misses += 1
+        CACHE_LOOKUPS.labels("miss").inc()
+        task = asyncio.create_task(self._synthesize(key, text, voice, fmt))
+        self.in_flight[key] = task
+        task.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        return await asyncio.shield(task), "miss"
+
+    async def _synthesize(self, key, text, voice, fmt):
+        path = self.path_for(key, fmt)
+        with timed("tts_synthesis"):
+            async with aclosing(iter_audio_chunks(text, voice, fmt, path)) as chunks:
+                async for _ in chunks:
+                    pass
+        self._add(key, path, os.path.getsize(path))
+        self._evict(keep=key)
+        return path
+
+    def _add(self, key, path, size):
+        self.discard(key)
+        self.entries[key] = (path, size)
+        self.total_bytes += size
+
+    def _evict(self, keep=None):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key = next(iter(self.entries))
+            if key == keep:
+                break
+            path, size = self.entries.popitem(last=False)[1]
+            self.total_bytes -= size
+            self.evictions += 1
+            CACHE_EVICTIONS.inc()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def stats(self):
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+            "entries": len(self.entries),
+            "bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "in_flight": len(self.in_flight),
+            "hit_rate": (self.hits + self.coalesced) / lookups if lookups else 0.0
+        }
+
+synthesis_cache = SynthesisCache(AUDIO_DIR, TTS_CACHE_MAX_BYTES)
+Gauge("voice_tts_cache_bytes", "Bytes of cached audio").set_function(lambda: synthesis_cache.total_bytes)
+Gauge("voice_tts_cache_entries", "Cached audio files").set_function(lambda: len(synthesis_cache.entries))
+Gauge("voice_tts_in_flight", "Syntheses in progress").set_function(lambda: len(synthesis_cache.in_flight))
+
+# This service's files and the STT service's uploads and recordings
+AUDIO_PREFIXES = ("tts_", "stream_", "upload_", "esp32_", "request_")
+audio_janitor = AudioJanitor(AUDIO_DIR, AUDIO_PREFIXES, AUDIO_MAX_AGE_S, AUDIO_MAX_BYTES,
+                             AUDIO_CLEANUP_INTERVAL_S, on_remove=synthesis_cache.forget)
+Gauge("voice_audio_files", "Audio files kept in the shared AUDIO_DIR").set_function(lambda: audio_janitor.files)
+Gauge("voice_audio_bytes", "Bytes of audio kept in the shared AUDIO_DIR").set_function(lambda: audio_janitor.bytes)
+
+# Served names carry their shard: <prefix>_<uuid4 hex or sha256 hex>.<ext>. Legacy
+# timestamp names don't match, so they are neither sharded nor served as immutable.
+AUDIO_NAME_PATTERN = re.compile(r"^[a-z0-9]+_([0-9a-f]{2})(?:[0-9a-f]{30}|[0-9a-f]{62})\.\w+$")
+
+def find_audio_file(filename):
+    """Locate a file served by name, in its shard or at the top level for files from before sharding"""
+    match = AUDIO_NAME_PATTERN.match(filename)
+    if match:
+        file_path = os.path.join(AUDIO_DIR, match.group(1), filename)
+        if os.path.exists(file_path):
+            return file_path
+    return os.path.join(AUDIO_DIR, filename)
+
+AUDIO_ROOT = os.path.realpath(AUDIO_DIR)
+AUDIO_CHUNK_SIZE = 64 * 1024  # Read size when serving part of a file
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+BYTE_RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+def audio_etag(file_stat):
+    """Strong validator for a served file.
+
+    mtime is not used because cache hits touch it; a file only changes by
+    being replaced (resynthesis after eviction), which gives it a new inode.
+    """
+    return f'"{file_stat.st_ino:x}-{file_stat.st_size:x}"'
+
+def is_not_modified(request, etag, mtime):
+    """Evaluate If-None-Match, or failing that If-Modified-Since"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or any(tag.replace("W/", "", 1) == etag for tag in tags)
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def parse_byte_range(header, size):
+    """Parse a single-range Range header into an inclusive (start, end).
+
+    Returns None when the header is absent or not a single byte range, in which
+    case the whole file is sent, and raises ValueError when it can't be satisfied.
+    """
+    match = BYTE_RANGE_PATTERN.match(header.strip()) if header else None
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        suffix = int(last)
+        if suffix == 0:
+            raise ValueError("Empty suffix range")
+        start, end = max(size - suffix, 0), size - 1
+    if start >= size:
+        raise ValueError("Range starts past the end of the file")
+    return start, end
+
+async def iter_file_range(file, start, length):
+    """Yield part of an open file in chunks read off the event loop"""
+    try:
+        file.seek(start)
+        while length > 0:
+            chunk = await asyncio.to_thread(file.read, min(AUDIO_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+@app.on_event("startup")
+async def startup_event():
+    """Event handler for application startup"""
+    synthesis_cache.load()
+    start_background_task(audio_janitor.run())
 
 @app.get("/")
 async def root():
     return {"message": "Text-to-Speech Service is running"}
 
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 @app.get("/voices")
 async def list_voices():
     """List all available voices"""
@@ -61,23 +681,32 @@ async def list_voices():
 
 @app.post("/synthesize")
 async def synthesize_speech(request: TTSRequest):
-    """Synthesize speech and return audio file path"""
+    """Synthesize speech and return the audio file path, or with inline set, the audio bytes"""
+    if request.format not in MEDIA_TYPES:
+        return unsupported_format_response(request.format)
+    
     try:
-        # Generate unique filename
-        timestamp = int(time.time())
-        filename = f"tts_{timestamp}.{request.format}"
-        file_path = os.path.join(AUDIO_DIR, filename)
+        # Reuse cached audio for identical text/voice/format, otherwise synthesize once
+        file_path, cache_status = await synthesis_cache.get_or_synthesize(
+            request.text, request.voice, request.format
+        )
         
-        # Use Edge TTS to synthesize speech
-        communicate = edge_tts.Communicate(request.text, request.voice)
-        await communicate.save(file_path)
+        logger.info(f"Speech synthesized ({cache_status}): {file_path}")
         
-        logger.info(f"Speech synthesized: {file_path}")
+        if request.inline:
+            # Read now rather than streaming from the path, which the cache may evict meanwhile
+            audio = await asyncio.to_thread(Path(file_path).read_bytes)
+            return Response(
+                content=audio,
+                media_type=MEDIA_TYPES[request.format],
+                headers={"X-Audio-Format": request.format, "X-Cache": cache_status}
+            )
         
         return {
             "audio_path": file_path,
             "format": request.format,
-            "voice": request.voice
+            "voice": request.voice,
+            "cached": cache_status != "miss"
         }
     
     except Exception as e:
@@ -87,44 +716,188 @@ async def synthesize_speech(request: TTSRequest):
             content={"error": f"Speech synthesis error: {str(e)}"}
         )
 
-@app.get("/audio/{filename}")
-async def get_audio(filename: str):
-    """Get synthesized audio file"""
-    file_path = os.path.join(AUDIO_DIR, filename)
+@app.get("/cache/stats")
+async def cache_stats():
+    """Get synthesis cache statistics"""
+    return synthesis_cache.stats()
+
+@app.get("/storage/stats")
+async def storage_stats():
+    """Get file count and size of the audio in AUDIO_DIR, as of the last cleanup sweep"""
+    return audio_janitor.stats()
+
+@app.api_route("/audio/{filename}", methods=["GET", "HEAD"])
+async def get_audio(filename: str, request: Request):
+    """Get synthesized audio file.
+
+    Generated names are unique, so responses carry a strong ETag and may be
+    cached indefinitely; revalidation is answered with 304 and a Range header
+    with 206 Partial Content.
+    """
+    file_path = find_audio_file(filename)
     
-    if not os.path.exists(file_path):
+    # Only regular files inside AUDIO_DIR; partial files are still being written
+    try:
+        if filename.endswith(".part") or os.path.commonpath([os.path.realpath(file_path), AUDIO_ROOT]) != AUDIO_ROOT:
+            raise FileNotFoundError(filename)
+        file_stat = os.stat(file_path)
+        if not S_ISREG(file_stat.st_mode):
+            raise FileNotFoundError(filename)
+    except (OSError, ValueError):
         raise HTTPException(status_code=404, detail="Audio file does not exist")
     
-    return FileResponse(file_path)
+    etag = audio_etag(file_stat)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(file_stat.st_mtime, usegmt=True),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL if AUDIO_NAME_PATTERN.match(filename) else "no-cache",
+        "Accept-Ranges": "bytes"
+    }
+    if is_not_modified(request, etag, file_stat.st_mtime):
+        return Response(status_code=304, headers=headers)
+    
+    media_type = MEDIA_TYPES.get(filename.rsplit(".", 1)[-1], "application/octet-stream")
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    if if_range is None or if_range.strip() == etag:
+        try:
+            byte_range = parse_byte_range(request.headers.get("range"), file_stat.st_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{file_stat.st_size}"})
+    
+    if byte_range is None:
+        return FileResponse(file_path, media_type=media_type, headers=headers, stat_result=file_stat)
+    
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{file_stat.st_size}"
+    headers["Content-Length"] = str(end - start + 1)
+    if request.method == "HEAD":
+        return Response(status_code=206, headers=headers, media_type=media_type)
+    return StreamingResponse(
+        iter_file_range(open(file_path, "rb"), start, end - start + 1),
+        status_code=206,
+        media_type=media_type,
+        headers=headers
+    )
+
+async def iter_edge_tts_mp3(text, voice):
+    communicate = edge_tts.Communicate(text, voice)
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            yield chunk["data"]
+
+async def iter_audio_chunks(text, voice, fmt, file_path=None):
+    """Yield audio bytes in fmt as they are produced, optionally teeing them to disk.
+
+    The copy only appears under file_path once complete, since served files are
+    treated as immutable.
+    """
+    tmp_path = f"{file_path}.part"
+    output = open(tmp_path, "wb") if file_path else None
+    complete = False
+    try:
+        async with aclosing(transcode_chunks(iter_edge_tts_mp3(text, voice), fmt)) as chunks:
+            async for data in chunks:
+                if output:
+                    output.write(data)
+                yield data
+        complete = True
+    finally:
+        if output:
+            output.close()
+            if complete:
+                os.replace(tmp_path, file_path)
+            else:
+                os.remove(tmp_path)
 
 @app.post("/stream")
-async def stream_audio(request: TTSRequest):
+async def stream_audio(request: StreamRequest):
     """Stream audio synthesis (for real-time transmission to ESP32)"""
-    try:
-        # Generate unique filename
-        timestamp = int(time.time())
-        filename = f"stream_{timestamp}.{request.format}"
-        file_path = os.path.join(AUDIO_DIR, filename)
-        
-        # Use Edge TTS to synthesize speech
-        communicate = edge_tts.Communicate(request.text, request.voice)
-        
-        # Direct save
-        await communicate.save(file_path)
-        
-        logger.info(f"Streaming speech synthesized: {file_path}")
-        
-        return {
-            "audio_path": file_path,
-            "status": "ready"
-        }
+    if request.format not in MEDIA_TYPES:
+        return unsupported_format_response(request.format)
+    media_type = MEDIA_TYPES[request.format]
+    
+    # Serve previously synthesized audio straight from the cache
+    cached_path = synthesis_cache.lookup(synthesis_cache.make_key(request.text, request.voice, request.format))
+    if cached_path:
+        synthesis_cache.hits += 1
+        CACHE_LOOKUPS.labels("hit").inc()
+        return FileResponse(cached_path, media_type=media_type, headers={"X-Audio-Path": cached_path})
+    
+    headers = {}
+    file_path = None
+    if request.save:
+        file_path = new_audio_path("stream", request.format)
+        headers["X-Audio-Path"] = file_path
     
+    chunks = iter_audio_chunks(request.text, request.voice, request.format, file_path)
+    
+    # Pull the first chunk before responding so synthesis errors still return a proper status
+    try:
+        with timed("tts_first_chunk"):
+            first_chunk = await chunks.__anext__()
+    except StopAsyncIteration:
+        first_chunk = b""
     except Exception as e:
         logger.error(f"Streaming speech synthesis error: {str(e)}")
         return JSONResponse(
             status_code=500,
             content={"error": f"Streaming speech synthesis error: {str(e)}"}
         )
+    
+    async def body():
+        yield first_chunk
+        async for data in chunks:
+            yield data
+        if file_path:
+            logger.info(f"Streaming speech synthesized: {file_path}")
+    
+    return StreamingResponse(body(), media_type=media_type, headers=headers)
+
+@app.websocket("/ws/stream")
+async def stream_audio_ws(websocket: WebSocket):
+    """WebSocket streaming synthesis: send a TTS request as JSON, receive binary audio frames"""
+    await websocket.accept()
+    
+    try:
+        while True:
+            message = await websocket.receive_json()
+            try:
+                request = StreamRequest(**message)
+            except Exception as e:
+                await websocket.send_json({"type": "error", "error": f"Invalid request: {str(e)}"})
+                continue
+            if request.format not in MEDIA_TYPES:
+                await websocket.send_json({"type": "error", "error": f"Unsupported format: {request.format}"})
+                continue
+            
+            file_path = None
+            if request.save:
+                file_path = new_audio_path("stream", request.format)
+            
+            try:
+                total_bytes = 0
+                async for data in iter_audio_chunks(request.text, request.voice, request.format, file_path):
+                    total_bytes += len(data)
+                    await websocket.send_bytes(data)
+                
+                end_frame = {"type": "end", "bytes": total_bytes, "format": request.format}
+                if file_path:
+                    end_frame["audio_path"] = file_path
+                await websocket.send_json(end_frame)
+            
+            except WebSocketDisconnect:
+                raise
+            
+            except Exception as e:
+                logger.error(f"Streaming speech synthesis error: {str(e)}")
+                await websocket.send_json({"type": "error", "error": f"Streaming speech synthesis error: {str(e)}"})
+    
+    except WebSocketDisconnect:
+        pass
+    
+    except Exception as e:
+        logger.error(f"WebSocket error: {str(e)}")
 
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=8001, reload=False)
\ No newline at end of file
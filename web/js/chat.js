@@ -45,12 +45,17 @@ async function sendTextToAI() {
                 addMessageToChat('system', `Expression: ${data.expression}`);
             }
             
-            // Handle audio playback
-            if (data.audio_path) {
+            // Handle audio playback: inline base64 audio, or a file on the TTS service
+            if (data.audio_base64 || data.audio_path) {
                 // Create complete audio URL
-                const audioServer = API_URLS.tts;
-                const audioFilename = data.audio_path.split('/').pop();
-                const audioUrl = `${audioServer}/audio/${audioFilename}`;
+                let audioUrl;
+                if (data.audio_base64) {
+                    audioUrl = `data:${audioMimeType(data.audio_format)};base64,${data.audio_base64}`;
+                } else {
+                    const audioServer = API_URLS.tts;
+                    const audioFilename = data.audio_path.split('/').pop();
+                    audioUrl = `${audioServer}/audio/${audioFilename}`;
+                }
                 
                 // Set audio player
                 const audioPlayer = document.getElementById('audio-player');
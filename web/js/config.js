@@ -7,6 +7,12 @@ const API_URLS = {
     ollama: 'http://localhost:11434'
 };
 
+// MIME type for an audio format name returned by the services
+function audioMimeType(format) {
+    const types = { mp3: 'audio/mpeg', wav: 'audio/wav', ogg: 'audio/ogg', opus: 'audio/ogg' };
+    return types[format] || 'audio/mpeg';
+}
+
 // Service name mapping
 const SERVICE_NAMES = {
     coordinator: 'Coordinator',
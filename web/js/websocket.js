@@ -3,6 +3,78 @@
 // WebSocket connection
 let wsConnection = null;
 
+// Element receiving the reply currently being streamed
+let wsStreamElement = null;
+
+// Sentence audio segments waiting to be played in order
+const wsSegmentQueue = [];
+let wsSegmentPlaying = false;
+
+// Frame whose audio arrives in the next binary message
+let wsPendingAudio = null;
+
+// Play the next queued audio segment
+function playNextSegment() {
+    const next = wsSegmentQueue.shift();
+    if (!next) {
+        wsSegmentPlaying = false;
+        return;
+    }
+    wsSegmentPlaying = true;
+    next.onended = playNextSegment;
+    next.onerror = playNextSegment;
+    next.play().catch(playNextSegment);
+}
+
+// URL of a file on the TTS service for a frame that carries an audio path
+function audioPathUrl(audioPath) {
+    const audioFilename = audioPath.split('/').pop();
+    return `${API_URLS.tts}/audio/${audioFilename}`;
+}
+
+// Queue an audio segment for sequential playback
+function enqueueAudioSegment(audioUrl) {
+    wsSegmentQueue.push(new Audio(audioUrl));
+    if (!wsSegmentPlaying) {
+        playNextSegment();
+    }
+}
+
+// Show a player for the audio of a complete response
+function showResponseAudio(outputArea, audioUrl) {
+    const audioElement = document.createElement('audio');
+    audioElement.controls = true;
+    audioElement.src = audioUrl;
+    audioElement.style.width = '100%';
+    audioElement.style.marginTop = '10px';
+    
+    const audioContainer = document.createElement('div');
+    audioContainer.className = 'console-output';
+    audioContainer.innerHTML = '<strong>Audio response received:</strong><br>';
+    audioContainer.appendChild(audioElement);
+    
+    outputArea.appendChild(audioContainer);
+    
+    // Auto play
+    audioElement.play().catch(() => {});
+}
+
+// Play inline audio received as a binary message after the frame that announced it
+function handleInlineAudio(outputArea, buffer) {
+    const frame = wsPendingAudio;
+    wsPendingAudio = null;
+    if (!frame) {
+        return;
+    }
+    const blob = new Blob([buffer], { type: audioMimeType(frame.audio_format) });
+    const audioUrl = URL.createObjectURL(blob);
+    if (frame.type === 'audio_segment') {
+        enqueueAudioSegment(audioUrl);
+    } else {
+        showResponseAudio(outputArea, audioUrl);
+    }
+}
+
 // Connect WebSocket
 function connectWebSocket() {
     if (wsConnection) {
@@ -12,6 +84,7 @@ function connectWebSocket() {
     
     const wsUrl = `ws://${window.location.hostname}:8080/ws`;
     wsConnection = new WebSocket(wsUrl);
+    wsConnection.binaryType = 'arraybuffer';
     
     const statusElement = document.getElementById('ws-status');
     statusElement.textContent = 'Connecting...';
@@ -33,31 +106,45 @@ function connectWebSocket() {
     
     // Message received
     wsConnection.onmessage = function(event) {
+        if (event.data instanceof ArrayBuffer) {
+            handleInlineAudio(outputArea, event.data);
+            return;
+        }
+        
         try {
             const data = JSON.parse(event.data);
+            
+            // Inline audio for this frame follows as a binary message
+            if (data.audio_bytes) {
+                wsPendingAudio = data;
+            }
+            
+            // Streamed tokens are appended to a single element
+            if (data.type === 'token') {
+                if (!wsStreamElement) {
+                    wsStreamElement = document.createElement('div');
+                    wsStreamElement.className = 'console-output';
+                    outputArea.appendChild(wsStreamElement);
+                }
+                wsStreamElement.textContent += data.text;
+                outputArea.scrollTop = outputArea.scrollHeight;
+                return;
+            }
+            
+            // Sentence audio is played in order while the reply is still streaming
+            if (data.type === 'audio_segment') {
+                if (data.audio_path) {
+                    enqueueAudioSegment(audioPathUrl(data.audio_path));
+                }
+                return;
+            }
+            wsStreamElement = null;
+            
             outputArea.innerHTML += `<div class="console-output">Message received:<br><pre>${JSON.stringify(data, null, 2)}</pre></div>`;
             
             // If there's an audio path, display audio player
             if (data.audio_path) {
-                const audioServer = API_URLS.tts;
-                const audioFilename = data.audio_path.split('/').pop();
-                const audioUrl = `${audioServer}/audio/${audioFilename}`;
-                
-                const audioElement = document.createElement('audio');
-                audioElement.controls = true;
-                audioElement.src = audioUrl;
-                audioElement.style.width = '100%';
-                audioElement.style.marginTop = '10px';
-                
-                const audioContainer = document.createElement('div');
-                audioContainer.className = 'console-output';
-                audioContainer.innerHTML = '<strong>Audio response received:</strong><br>';
-                audioContainer.appendChild(audioElement);
-                
-                outputArea.appendChild(audioContainer);
-                
-                // Auto play
-                audioElement.play().catch(() => {});
+                showResponseAudio(outputArea, audioPathUrl(data.audio_path));
             }
         } catch (e) {
             outputArea.innerHTML += `<div class="console-output">Message received: ${event.data}</div>`;
@@ -113,7 +200,8 @@ function sendWebSocketMessage() {
     // Create message object
     const messageObj = {
         type: 'text',
-        text: message
+        text: message,
+        stream: document.getElementById('ws-stream').checked
     };
     
     // Send message